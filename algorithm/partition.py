@@ -1,8 +1,13 @@
 import argparse
 import numpy as np
 
+import src.Partitioner
+import src.Profiler
+
 parser = argparse.ArgumentParser(description="Add topo")
-parser.add_argument('--topo', type=int, nargs='+', help="Topo", required=False, default=[0])
+parser.add_argument('--topo', type=int, nargs='+', help="Number of clients of each layer", required=True)
+parser.add_argument('--profiles', type=str, nargs='+', required=False,
+                    help="Profile of each layer written by algorithm/profiling.py, instead of the tables below")
 args = parser.parse_args()
 topo = args.topo
 
@@ -34,48 +39,24 @@ size_data = [33554432, 33554432, 33554432, 33554432, 33554432, 33554432, 8388608
              262144, 262144, 262144, 2097152, 2097152, 2097152, 2097152, 2097152, 5120]
 
 # LAN
-# a1_2 = 5.321956086901455
-# a2_3 = 11.684686209372796
+# bandwidth = 1e9 / 5.321956086901455
 # 5G
-a1_2 = 50
-a2_3 = 50
-
-layer1_exe = t_exe_1
-layer1_comm_data = [x * a1_2 for x in size_data]
-layer2_exe = t_exe_2
-layer2_comm_data = [x * a2_3 for x in size_data]
-layer2_comm_grad = [x * a1_2 for x in size_data]
-layer3_exe = t_exe_3
-layer3_comm_grad = [x * a2_3 for x in size_data]
-time_min = float('inf')
-result = None
-
-training_time_rate = 3
-
-if len(topo) == 2:
-    for i in range(1, len(size_data) - 1):
-        layer1 = (sum(layer1_exe[:i]) * (training_time_rate + 1) + layer1_comm_data[i - 1]) / topo[0]
-        layer2 = (sum(layer2_exe[i:]) * (training_time_rate + 1) + layer2_comm_grad[i - 1]) / topo[1]
-
-        time_max = max(layer1, layer2)
-        if time_max < time_min:
-            result = [i]
-            time_min = time_max
-if len(topo) == 3:
-    for i in range(1, len(size_data) - 1):
-        for j in range(i + 1, len(size_data)):
-            layer1 = (sum(layer1_exe[:i]) * (training_time_rate + 1) + layer1_comm_data[i - 1]) / topo[0]
-            layer2 = (sum(layer2_exe[i:j]) * (training_time_rate + 1) + layer2_comm_data[j - 1] + layer2_comm_grad[i - 1]) / topo[1]
-            layer3 = (sum(layer3_exe[j:]) * (training_time_rate + 1) + layer3_comm_grad[j - 1]) / topo[2]
-
-            time_max = max(layer1, layer2, layer3)
-            if time_max < time_min:
-                result = [i, j]
-                time_min = time_max
-
-print(f"Partition at: {result} - {np.array(size_data)[result]}")
+bandwidth = 1e9 / 50  # bytes/s
+
+if args.profiles:
+    if len(args.profiles) != len(topo):
+        parser.error("--profiles needs one file per layer of --topo")
+    profiles = [src.Profiler.load_profile(path) for path in args.profiles]
+    size_data = profiles[0]["output_bytes"]
+    stage_profiles = [[profile] * clients for profile, clients in zip(profiles, topo)]
+    bandwidths = [[profile.get("bandwidth", bandwidth)] * clients for profile, clients in zip(profiles, topo)]
+else:
+    stage_exe = [t_exe_1, t_exe_2, t_exe_3]
+    if not 2 <= len(topo) <= len(stage_exe):
+        parser.error(f"--topo needs between 2 and {len(stage_exe)} layers")
+    stage_profiles = [[{"forward": stage_exe[k]}] * clients for k, clients in enumerate(topo)]
+    bandwidths = [[bandwidth] * clients for clients in topo]
+result, time_min = src.Partitioner.partition(stage_profiles, size_data, bandwidths)
+
+print(f"Partition at: {result} - {np.array(size_data)[np.array(result) - 1]}")
 print(f"Time min = {time_min/1000000000} s")
-
-# print(sum(t_exe_1) * (training_time_rate + 1) / 1000000000)
-# print(sum(t_exe_2) * (training_time_rate + 1) / 1000000000)
-# print(sum(t_exe_3) * (training_time_rate + 1) / 1000000000)
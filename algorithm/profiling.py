@@ -1,81 +1,50 @@
-import torch
-import torch.nn as nn
-import time
 import argparse
-import numpy as np
+import yaml
 
-import torchvision
-import torchvision.transforms as transforms
+import torch
 
-import src.Model
+import src.Profiler
+from src.Transport import create_transport
 
-parser = argparse.ArgumentParser(description="Split learning framework")
+parser = argparse.ArgumentParser(description="Profile every layer of a model, and optionally the link to the broker")
+parser.add_argument('--model', type=str, default='VGG16', help='Class name of the model in src.Model')
 parser.add_argument('--device', type=str, required=False, help='Device of client')
-parser.add_argument('--round', type=int, required=False, help='Profiling round')
-parser.add_argument('--batch_size', type=int, required=False, help='Batch size')
-
-args = parser.parse_args()
-
-device = None
-
-if args.device is None:
-    if torch.cuda.is_available():
-        device = "cuda"
-        print(f"Using device: {torch.cuda.get_device_name(device)}")
-    else:
-        device = "cpu"
-        print(f"Using device: CPU")
-else:
-    device = args.device
-    print(f"Using device: {device}")
-
-model = src.Model.VGG16().to(device)
-batch_size = 128
-test_round = 100
-if args.round:
-    test_round = args.round
+parser.add_argument('--round', type=int, default=100, help='Profiling round')
+parser.add_argument('--warmup', type=int, default=5, help='Rounds run before measuring')
+parser.add_argument('--batch_size', type=int, default=128, help='Batch size')
+parser.add_argument('--config', type=str, required=False, help='Also probe the transport of this configuration')
+parser.add_argument('--output', type=str, default='profile.json', help='JSON file read by algorithm/partition.py')
 
-full_model = []
-for sub_model in nn.Sequential(*nn.ModuleList(model.children())):
-    full_model.append(sub_model)
-
-transform_test = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-])
-
-testset = torchvision.datasets.CIFAR10(
-    root='./data', train=False, download=False, transform=transform_test)
-test_loader = torch.utils.data.DataLoader(
-    testset, batch_size=batch_size, shuffle=False, num_workers=2)
-
-data_size = []
-forward_time = []
-
-train_data = None
-
-for (data, target) in test_loader:
-    data = data.to(device)
-    train_data = data
-    break
 
 if __name__ == '__main__':
-    for i in range(test_round):
-        data = train_data
-        times = []
-        for sub_model in full_model:
-            sub_model.train()
-            start = time.time_ns()
-            data = sub_model(data)
-            end = time.time_ns()
-            if i == 0:
-                data_size.append(data.nelement() * data.element_size())
-            times.append(end-start)
-        forward_time.append(times)
+    args = parser.parse_args()
 
-    forward_time = np.array(forward_time)
-    forward_time = np.average(forward_time, axis=0)
-    forward_time = forward_time.tolist()
+    device = None
 
-    print(f"List of forward training time = {forward_time} nano second")
-    print(f"List of data size = {data_size} bytes")
+    if args.device is None:
+        if torch.cuda.is_available():
+            device = "cuda"
+            print(f"Using device: {torch.cuda.get_device_name(device)}")
+        else:
+            device = "cpu"
+            print(f"Using device: CPU")
+    else:
+        device = args.device
+        print(f"Using device: {device}")
+
+    profile = src.Profiler.profile_model(args.model, args.batch_size, device, args.round, args.warmup)
+    if args.config:
+        with open(args.config, 'r') as file:
+            config = yaml.safe_load(file)
+        link = src.Profiler.probe_link(create_transport(config), 'probe_profiling')
+        profile["bandwidth"] = link["bandwidth"]
+        profile["latency"] = link["latency"]
+        print(f"Link: latency {link['latency'] * 1e3:.3f} ms, throughput {link['bandwidth'] / 2 ** 20:.2f} MB/s")
+
+    print(f"List of forward training time = {profile['forward']} nano second")
+    print(f"List of backward training time = {profile['backward']} nano second")
+    print(f"List of activation memory = {profile['activation_memory']} bytes")
+    print(f"List of data size = {profile['output_bytes']} bytes")
+
+    src.Profiler.save_profile(profile, args.output)
+    print(f"Profile saved to {args.output}")
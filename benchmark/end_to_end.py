@@ -0,0 +1,244 @@
+import sys
+import os
+import io
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import itertools
+import threading
+import contextlib
+import multiprocessing
+import queue as queue_module
+
+import yaml
+import numpy as np
+import torchvision.transforms as transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.Model
+from src.Dataset import CIFAR10_MEAN, CIFAR10_STD, SyntheticCIFAR10
+from src.RpcClient import RpcClient
+from src.Scheduler import Scheduler
+from src.Server import Server
+from src.Transport import LocalBroker, LocalManager, LocalTransport, create_transport
+
+# learning.compute presets: none leaves torch as is, threads sizes and pins every client, auto also uses channels_last
+COMPUTE = {
+    "none": None,
+    "threads": {"threads": "auto", "interop-threads": 1, "affinity": "auto", "channels-last": False},
+    "auto": {"threads": "auto", "interop-threads": 1, "affinity": "auto", "channels-last": True},
+}
+
+parser = argparse.ArgumentParser(description="Throughput of whole split training runs on synthetic CIFAR-shaped data")
+parser.add_argument('--config', type=str, default='config.yaml', help='Base configuration, its learning options are kept')
+parser.add_argument('--models', type=str, nargs='+', default=['LeNet'], help='Models to sweep, e.g. VGG16 VGG19 LeNet MobileNetv1')
+parser.add_argument('--cut_layers', type=str, nargs='+', help='Cut layers to sweep, e.g. 7,14 10,20 (default: split evenly)')
+parser.add_argument('--clients', type=str, nargs='+', default=['1,1,1'], help='Clients of each layer to sweep, e.g. 1,1,1 2,1,1')
+parser.add_argument('--batch_size', type=int, nargs='+', default=[128], help='Batch sizes to sweep')
+parser.add_argument('--control_count', type=int, nargs='+', default=[3], help='control-count values to sweep')
+parser.add_argument('--compute', type=str, nargs='+', default=['none', 'auto'], choices=list(COMPUTE),
+                    help='Compute presets to sweep, the gain is reported against the first one')
+parser.add_argument('--samples', type=int, default=100, help='Samples per label of each first layer client per round')
+parser.add_argument('--round', type=int, default=2, help='Rounds per configuration, the first one is a warm-up')
+parser.add_argument('--mode', type=str, default='process', choices=['process', 'thread'], help='Run clients as processes or as threads of this process')
+parser.add_argument('--device', type=str, default='cpu', help='Device of clients')
+parser.add_argument('--output', type=str, default='end_to_end.json', help='JSON file of the results')
+parser.add_argument('--verbose', action='store_true', help='Keep the output of the server and clients')
+
+
+class BenchmarkServer(Server):
+    """Server handing the stats of every UPDATE of a round over to the benchmark."""
+
+    def __init__(self, config_dir, broker, results, samples):
+        super().__init__(config_dir, broker)
+        self.label_count = [samples for _ in range(len(self.label_count))]
+        self.results = results
+        self.updates = []
+
+    def on_request(self, message):
+        if message["action"] == "UPDATE":
+            self.updates.append((message["layer_id"], message["stats"]))
+            if len(self.updates) == sum(self.total_clients):
+                self.results.put({"round_time": (time.time_ns() - self.time_start) / 1e9, "updates": self.updates})
+                self.updates = []
+        super().on_request(message)
+
+
+def quiet(verbose):
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def run_server(config_dir, broker, results, samples, verbose):
+    with quiet(verbose):
+        server = BenchmarkServer(config_dir, broker, results, samples)
+        server.start()
+
+
+def run_client(config, layer_id, device, broker, samples, verbose, slot=None):
+    with quiet(verbose):
+        client_id = uuid.uuid4()
+        train_set = None
+        if layer_id == 1:
+            transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(CIFAR10_MEAN, CIFAR10_STD)])
+            train_set = SyntheticCIFAR10(10 * samples, transform)
+        scheduler = Scheduler(client_id, layer_id, create_transport(config, broker), device)
+        client = RpcClient(client_id, layer_id, LocalTransport(broker), scheduler.train_on_device, device, train_set,
+                           slot)
+        client.send_to_server({"action": "REGISTER", "client_id": client_id, "layer_id": layer_id,
+                               "message": "Hello from Client!"})
+        client.wait_response()
+
+
+def default_cut_layers(model_name, num_stages):
+    # Cut before layers with parameters, so that every stage has some to train
+    layers = list(getattr(src.Model, model_name)().children())
+    trainable = [index for index, layer in enumerate(layers) if any(True for _ in layer.parameters())]
+    return [trainable[round(len(trainable) * stage / num_stages)] for stage in range(1, num_stages)]
+
+
+def run(config, args, samples):
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as file:
+        yaml.safe_dump(config, file)
+        config_dir = file.name
+
+    layers = [(layer_id, config, args.device)
+              for layer_id, num_clients in enumerate(config["server"]["clients"], start=1)
+              for _ in range(num_clients)]
+    if args.mode == "process":
+        manager = LocalManager()
+        manager.start()
+        broker = manager.LocalBroker()
+        results = manager.Queue()
+        workers = [multiprocessing.Process(target=run_server,
+                                           args=(config_dir, broker, results, samples, args.verbose))]
+        # Clients are pinned to their own CPUs by compute.affinity auto, threads of one process cannot be
+        workers += [multiprocessing.Process(target=run_client,
+                                            args=(config, layer_id, device, broker, samples, args.verbose,
+                                                  (index, len(layers))))
+                    for index, (layer_id, config, device) in enumerate(layers)]
+    else:
+        manager = None
+        broker = LocalBroker()
+        results = queue_module.Queue()
+        workers = [threading.Thread(target=run_server, args=(config_dir, broker, results, samples, True),
+                                    daemon=True)]
+        workers += [threading.Thread(target=run_client, args=(config, layer_id, device, broker, samples, True),
+                                     daemon=True)
+                    for layer_id, config, device in layers]
+
+    with quiet(args.verbose or args.mode == "process"):
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    rounds = []
+    while not results.empty():
+        rounds.append(results.get())
+    if manager:
+        manager.shutdown()
+    os.remove(config_dir)
+    return rounds
+
+
+def summarize(rounds, num_layers, samples, first_layer_clients):
+    summaries = []
+    for result in rounds:
+        total_samples = 10 * samples * first_layer_clients
+        stages = []
+        for layer_id in range(1, num_layers + 1):
+            utilization = []
+            bubble = []
+            forward_time = []
+            backward_time = []
+            for update_layer, stats in result["updates"]:
+                if update_layer != layer_id:
+                    continue
+                step = stats["step"]
+                total_time = max(stats["pipeline"]["total_time"], 1)
+                utilization.append(step["steps"] * (step["forward_time"] + step["backward_time"]) / total_time)
+                bubble.append(stats["pipeline"]["bubble_time"] / total_time)
+                forward_time.append(step["forward_time"] / 1e6)
+                backward_time.append(step["backward_time"] / 1e6)
+            stages.append({"layer_id": layer_id, "utilization": float(np.mean(utilization)),
+                           "bubble": float(np.mean(bubble)), "forward_ms": float(np.mean(forward_time)),
+                           "backward_ms": float(np.mean(backward_time))})
+        # Activations and gradients sent by every client, as serialized tensors
+        sent_bytes = sum(report.get("sent_bytes", 0) for _, stats in result["updates"]
+                         for report in stats["compression"].values())
+        summaries.append({"round_time": result["round_time"], "samples": total_samples,
+                          "samples_per_s": total_samples / result["round_time"],
+                          "bytes": sent_bytes, "bytes_per_sample": sent_bytes / total_samples,
+                          "stages": stages})
+    return summaries
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with open(args.config, 'r') as file:
+        base_config = yaml.safe_load(file)
+
+    configurations = []
+    for model_name, clients, batch_size, control_count in itertools.product(args.models, args.clients,
+                                                                            args.batch_size, args.control_count):
+        clients = [int(count) for count in clients.split(",")]
+        if args.cut_layers:
+            cut_layers_list = [[int(cut) for cut in cut_layers.split(",")] for cut_layers in args.cut_layers]
+            cut_layers_list = [cut_layers for cut_layers in cut_layers_list if len(cut_layers) == len(clients) - 1]
+        else:
+            cut_layers_list = [default_cut_layers(model_name, len(clients))]
+        for cut_layers in cut_layers_list:
+            for compute in args.compute:
+                configurations.append((model_name, cut_layers, clients, batch_size, control_count, compute))
+
+    results = []
+    print(f"{'model':<12}{'cut layers':<14}{'clients':<10}{'batch':>6}{'control':>8}{'compute':>9}{'samples/s':>12}"
+          f"{'MB/round':>10}  utilization per layer")
+    for model_name, cut_layers, clients, batch_size, control_count, compute in configurations:
+        config = yaml.safe_load(yaml.safe_dump(base_config))
+        config["server"].update({"model": model_name, "cut_layers": cut_layers, "clients": clients,
+                                 "num-round": args.round, "validation": False, "partition": {"auto": False},
+                                 "parameters": {"load": False, "save": False}})
+        config["learning"].update({"batch-size": batch_size, "control-count": control_count,
+                                   "compute": COMPUTE[compute]})
+        config["transport"] = "local"
+        config["metrics"] = {"enable": False}
+        config["log_path"] = tempfile.gettempdir()
+
+        rounds = summarize(run(config, args, args.samples), len(clients), args.samples, clients[0])
+        # The first round also builds the models and starts the loaders
+        measured = rounds[1:] or rounds
+        result = {"model": model_name, "cut_layers": cut_layers, "clients": clients, "batch_size": batch_size,
+                  "control_count": control_count, "compute": compute, "mode": args.mode, "device": args.device,
+                  "samples_per_s": float(np.median([r["samples_per_s"] for r in measured])) if measured else None,
+                  "rounds": rounds}
+        results.append(result)
+
+        utilization = " ".join(f"{stage['utilization']:.2f}" for stage in measured[-1]["stages"]) if measured else ""
+        megabytes = measured[-1]["bytes"] / 2 ** 20 if measured else 0
+        print(f"{model_name:<12}{','.join(map(str, cut_layers)):<14}{','.join(map(str, clients)):<10}"
+              f"{batch_size:>6}{control_count:>8}{compute:>9}{result['samples_per_s'] or 0:>12.1f}{megabytes:>10.1f}  "
+              f"{utilization}")
+
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if len(args.compute) > 1:
+        # Throughput of every compute preset against the first one, for each cut configuration
+        print(f"\nGain over compute {args.compute[0]}")
+        baselines = {}
+        for result in results:
+            key = (result["model"], tuple(result["cut_layers"]), tuple(result["clients"]), result["batch_size"],
+                   result["control_count"])
+            baseline = baselines.setdefault(key, result["samples_per_s"])
+            result["gain"] = result["samples_per_s"] / baseline if baseline and result["samples_per_s"] else None
+            if result["compute"] != args.compute[0]:
+                print(f"{result['model']:<12}{','.join(map(str, result['cut_layers'])):<14}"
+                      f"{','.join(map(str, result['clients'])):<10}{result['batch_size']:>6}"
+                      f"{result['control_count']:>8}{result['compute']:>9}{result['gain'] or 0:>11.2f}x")
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    print(f"Results saved to {args.output}")
@@ -0,0 +1,76 @@
+import sys
+import os
+import time
+import uuid
+import pickle
+import argparse
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.Model
+import src.Serialization
+
+parser = argparse.ArgumentParser(description="Compare message serialization formats")
+parser.add_argument('--batch_size', type=int, default=128, help='Batch size')
+parser.add_argument('--cut_layer', type=int, default=10, help='Cut layer of VGG16')
+parser.add_argument('--round', type=int, default=20, help='Repetitions per message')
+
+args = parser.parse_args()
+
+
+def legacy_dumps(message):
+    # Format used before the binary frames: tensors converted to numpy arrays, then pickled
+    message = dict(message)
+    if isinstance(message.get("data"), torch.Tensor):
+        message["data"] = message["data"].numpy()
+    return pickle.dumps(message)
+
+
+def legacy_loads(body):
+    message = pickle.loads(body)
+    if "data" in message:
+        message["data"] = torch.tensor(message["data"])
+    return message
+
+
+def measure(dumps, loads, message):
+    body = dumps(message)
+    encode_time = []
+    decode_time = []
+    for _ in range(args.round):
+        start = time.perf_counter_ns()
+        body = dumps(message)
+        encode_time.append(time.perf_counter_ns() - start)
+        start = time.perf_counter_ns()
+        loads(body)
+        decode_time.append(time.perf_counter_ns() - start)
+    return len(body), sorted(encode_time)[len(encode_time) // 2] / 1000, sorted(decode_time)[len(decode_time) // 2] / 1000
+
+
+if __name__ == '__main__':
+    model = nn.Sequential(*nn.ModuleList(src.Model.VGG16().children()))
+    with torch.no_grad():
+        activation = model[:args.cut_layer](torch.randn(args.batch_size, 3, 32, 32))
+
+    trace = [uuid.uuid4()]
+    messages = {
+        "activation": {"data_id": uuid.uuid4(), "data": activation, "label": torch.randint(0, 10, (args.batch_size,)),
+                       "trace": trace, "test": False},
+        "gradient": {"data_id": uuid.uuid4(), "data": torch.randn_like(activation), "trace": trace, "test": False},
+        "update": {"action": "UPDATE", "client_id": uuid.uuid4(), "layer_id": 1, "result": True, "size": 1,
+                   "message": "Sent parameters to Server", "parameters": model[:args.cut_layer].state_dict()},
+    }
+    formats = {
+        "legacy": (legacy_dumps, legacy_loads),
+        "pickle": (lambda message: src.Serialization.dumps(message, "pickle"), src.Serialization.loads),
+        "binary": (lambda message: src.Serialization.dumps(message, "binary"), src.Serialization.loads),
+    }
+
+    print(f"{'message':<12}{'format':<10}{'bytes':>14}{'encode (us)':>14}{'decode (us)':>14}")
+    for name, message in messages.items():
+        for format_name, (dumps, loads) in formats.items():
+            size, encode_us, decode_us = measure(dumps, loads, message)
+            print(f"{name:<12}{format_name:<10}{size:>14}{encode_us:>14.1f}{decode_us:>14.1f}")
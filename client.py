@@ -1,4 +1,3 @@
-import pika
 import uuid
 import argparse
 import yaml
@@ -6,14 +5,17 @@ import yaml
 import torch
 
 import src.Log
+import src.Metrics
+import src.Profiler
 from src.RpcClient import RpcClient
 from src.Scheduler import Scheduler
+from src.Transport import create_transport
 
 
 parser = argparse.ArgumentParser(description="Split learning framework")
 parser.add_argument('--layer_id', type=int, required=True, help='ID of layer, start from 1')
 parser.add_argument('--device', type=str, required=False, help='Device of client')
-parser.add_argument('--event_time', type=bool, default=False, required=False, help='Log event time for debug mode')
+parser.add_argument('--event_time', type=bool, default=False, required=False, help='Trace named spans, merged by the server into a Chrome trace per round')
 
 args = parser.parse_args()
 
@@ -22,9 +24,6 @@ with open('config.yaml', 'r') as file:
 
 
 client_id = uuid.uuid4()
-address = config["rabbit"]["address"]
-username = config["rabbit"]["username"]
-password = config["rabbit"]["password"]
 
 device = None
 
@@ -39,15 +38,16 @@ else:
     device = args.device
     print(f"Using device: {device}")
 
-credentials = pika.PlainCredentials(username, password)
-connection = pika.BlockingConnection(pika.ConnectionParameters(address, 5672, '/', credentials))
-channel = connection.channel()
+transport = create_transport(config, async_io=config.get("async-io", False))
 
 
 if __name__ == "__main__":
+    src.Metrics.start_server(config)
     src.Log.print_with_color("[>>>] Client sending registration message to server...", "red")
     data = {"action": "REGISTER", "client_id": client_id, "layer_id": args.layer_id, "message": "Hello from Client!"}
-    scheduler = Scheduler(client_id, args.layer_id, channel, device, args.event_time)
-    client = RpcClient(client_id, args.layer_id, address, username, password, scheduler.train_on_device, device)
+    scheduler = Scheduler(client_id, args.layer_id, transport, device, args.event_time)
+    client = RpcClient(client_id, args.layer_id, create_transport(config), scheduler.train_on_device, device)
+    # Let the server choose the cut layers from the speed of every client and its link
+    data.update(src.Profiler.register_profile(client, config, config["server"]["model"]))
     client.send_to_server(data)
     client.wait_response()
@@ -0,0 +1,67 @@
+import uuid
+import argparse
+import multiprocessing
+import yaml
+
+import src.Log
+import src.Metrics
+import src.Profiler
+from src.RpcClient import RpcClient
+from src.Scheduler import Scheduler
+from src.Server import Server
+from src.Transport import LocalManager, LocalTransport, create_transport
+
+
+def run_server(config_dir, broker):
+    server = Server(config_dir, broker)
+    server.start()
+
+
+def run_client(config, layer_id, device, event_time, broker, index):
+    client_id = uuid.uuid4()
+    # Every process of this machine serves its metrics on its own port, the server on metrics.port
+    src.Metrics.start_server(config, index)
+    src.Log.print_with_color("[>>>] Client sending registration message to server...", "red")
+    data = {"action": "REGISTER", "client_id": client_id, "layer_id": layer_id, "message": "Hello from Client!"}
+    transport = create_transport(config, broker, async_io=config.get("async-io", False))
+    scheduler = Scheduler(client_id, layer_id, transport, device, event_time)
+    # With compute.affinity auto, every client is pinned to its own share of the CPUs of this machine
+    slot = (index - 1, sum(config["server"]["clients"]))
+    client = RpcClient(client_id, layer_id, LocalTransport(broker), scheduler.train_on_device, device, slot=slot)
+    # Let the server choose the cut layers from the speed of every client and its link
+    data.update(src.Profiler.register_profile(client, config, config["server"]["model"]))
+    client.send_to_server(data)
+    client.wait_response()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run server and all clients on this machine without RabbitMQ")
+    parser.add_argument('--config', type=str, default='config.yaml', help='Configuration file')
+    parser.add_argument('--device', type=str, default='cpu', help='Device of clients')
+    parser.add_argument('--event_time', type=bool, default=False, required=False, help='Trace named spans, merged by the server into a Chrome trace per round')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        config = yaml.safe_load(file)
+
+    manager = LocalManager()
+    manager.start()
+    broker = manager.LocalBroker()
+
+    server = multiprocessing.Process(target=run_server, args=(args.config, broker))
+    server.start()
+
+    clients = []
+    for layer_id, num_clients in enumerate(config["server"]["clients"], start=1):
+        for _ in range(num_clients):
+            client = multiprocessing.Process(target=run_client,
+                                             args=(config, layer_id, args.device, args.event_time, broker,
+                                                   len(clients) + 1))
+            client.start()
+            clients.append(client)
+
+    for client in clients:
+        client.join()
+    server.join()
+    manager.shutdown()
+    src.Log.print_with_color("Local run finished.", "green")
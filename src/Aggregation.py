@@ -0,0 +1,55 @@
+from collections import OrderedDict
+
+import torch
+
+
+class StreamingAverage:
+    """Weighted average of state_dicts, each one folded in as soon as it arrives.
+
+    Floating point entries are summed into one flat float32 buffer and integer entries
+    (e.g. num_batches_tracked) into one flat int64 buffer, so memory stays at one model
+    whatever the number of clients.
+    """
+
+    def __init__(self):
+        self.layout = None
+        self.float_sum = None
+        self.long_sum = None
+        self.total = 0
+        self.count = 0
+
+    def add(self, state_dict, weight):
+        if self.layout is None:
+            self.layout = []
+            float_size = 0
+            long_size = 0
+            for key, value in state_dict.items():
+                if value.is_floating_point():
+                    self.layout.append((key, value.shape, value.dtype, float_size))
+                    float_size += value.numel()
+                else:
+                    self.layout.append((key, value.shape, value.dtype, long_size))
+                    long_size += value.numel()
+            self.float_sum = torch.zeros(float_size, dtype=torch.float32)
+            self.long_sum = torch.zeros(long_size, dtype=torch.long)
+
+        for key, shape, dtype, offset in self.layout:
+            value = state_dict[key].reshape(-1)
+            if dtype.is_floating_point:
+                self.float_sum[offset:offset + value.numel()].add_(value, alpha=weight)
+            else:
+                self.long_sum[offset:offset + value.numel()].add_(value.long(), alpha=weight)
+        self.total += weight
+        self.count += 1
+
+    def result(self):
+        if self.count == 0:
+            return None
+        self.float_sum.div_(self.total)
+        self.long_sum.floor_divide_(self.total)
+
+        state_dict = OrderedDict()
+        for key, shape, dtype, offset in self.layout:
+            flat = self.float_sum if dtype.is_floating_point else self.long_sum
+            state_dict[key] = flat[offset:offset + shape.numel()].view(shape).to(dtype)
+        return state_dict
@@ -0,0 +1,135 @@
+import torch
+
+MODES = ["none", "fp16", "bf16", "int8", "topk"]
+
+
+def link_mode(compression, kind, link):
+    """Mode of `kind` ("activation" or "gradient") on cut `link` (0 is between layer 1 and 2)."""
+    if not compression or link < 0:
+        return "none"
+    mode = compression.get(kind, "none")
+    if isinstance(mode, list):
+        return mode[link] if link < len(mode) else "none"
+    return mode
+
+
+def payload_bytes(payload):
+    if isinstance(payload, torch.Tensor):
+        return payload.numel() * payload.element_size()
+    return sum(value.numel() * value.element_size() for value in payload.values() if isinstance(value, torch.Tensor))
+
+
+def decompress(payload):
+    if isinstance(payload, torch.Tensor):
+        return payload
+
+    mode = payload["mode"]
+    if mode in ("fp16", "bf16"):
+        return payload["data"].to(payload["dtype"])
+    elif mode == "int8":
+        return payload["data"].to(payload["dtype"]) * payload["scale"].to(payload["dtype"])
+    elif mode == "topk":
+        values = payload["values"].to(payload["dtype"])
+        dense = torch.zeros(torch.Size(payload["shape"]).numel(), dtype=values.dtype, device=values.device)
+        dense.scatter_(0, payload["indices"].long(), values)
+        return dense.view(payload["shape"])
+    else:
+        raise ValueError(f"Compression '{mode}' is not supported.")
+
+
+def state_dict_delta(compressor, state_dict, base):
+    """Compressed `state_dict - base`, tensors that are not floating point are sent whole."""
+    delta = {}
+    for key, value in state_dict.items():
+        if value.is_floating_point():
+            delta[key] = compressor.compress(value - base[key], key)
+        else:
+            delta[key] = value.detach().cpu()
+    return delta
+
+
+def apply_delta(base, delta):
+    state_dict = {}
+    for key, value in delta.items():
+        if base[key].is_floating_point():
+            state_dict[key] = base[key] + decompress(value).to(base[key].device)
+        else:
+            state_dict[key] = value
+    return state_dict
+
+
+class Compressor:
+    def __init__(self, mode="none", topk_ratio=0.01, error_feedback=True):
+        if mode not in MODES:
+            raise ValueError(f"Compression '{mode}' is not supported, use one of {MODES}.")
+        self.mode = mode
+        self.topk_ratio = topk_ratio
+        self.error_feedback = error_feedback
+        # Error feedback: what top-k dropped is added to the next tensor sent on the same key
+        self.residuals = {}
+
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.error = 0.0
+        self.count = 0
+
+    def compress(self, tensor, key=None):
+        tensor = tensor.detach()
+        if self.mode == "none":
+            payload = tensor.cpu()
+            self.raw_bytes += payload_bytes(payload)
+            self.sent_bytes += payload_bytes(payload)
+            self.count += 1
+            return payload
+
+        original = tensor
+        if self.mode == "topk" and self.error_feedback:
+            residual = self.residuals.get(key)
+            if residual is not None and residual.shape == tensor.shape:
+                tensor = tensor + residual
+
+        if self.mode == "fp16":
+            payload = {"mode": self.mode, "data": tensor.half(), "dtype": tensor.dtype}
+        elif self.mode == "bf16":
+            payload = {"mode": self.mode, "data": tensor.bfloat16(), "dtype": tensor.dtype}
+        elif self.mode == "int8":
+            if tensor.dim() >= 2:
+                # One scale per channel (dim 1)
+                dims = [dim for dim in range(tensor.dim()) if dim != 1]
+                scale = tensor.abs().amax(dim=dims, keepdim=True) / 127
+            else:
+                scale = tensor.abs().max() / 127
+            scale = scale.float().clamp(min=1e-12)
+            data = (tensor / scale).round().clamp(-127, 127).to(torch.int8)
+            payload = {"mode": self.mode, "data": data, "scale": scale, "dtype": tensor.dtype}
+        else:
+            flat = tensor.reshape(-1)
+            k = max(1, int(flat.numel() * self.topk_ratio))
+            indices = flat.abs().topk(k, sorted=False).indices
+            if flat.numel() < 2 ** 31:
+                indices = indices.int()
+            payload = {"mode": self.mode, "values": flat[indices.long()], "indices": indices,
+                       "shape": tuple(tensor.shape), "dtype": tensor.dtype}
+
+        restored = decompress(payload)
+        if self.mode == "topk" and self.error_feedback:
+            self.residuals[key] = tensor - restored
+
+        self.raw_bytes += payload_bytes(original)
+        self.sent_bytes += payload_bytes(payload)
+        self.error += ((original - restored).norm() / original.norm().clamp(min=1e-12)).item()
+        self.count += 1
+
+        return {name: value.cpu() if isinstance(value, torch.Tensor) else value for name, value in payload.items()}
+
+    def report(self):
+        """Compression ratio and mean relative error since the last report."""
+        report = {"mode": self.mode, "messages": self.count,
+                  "raw_bytes": self.raw_bytes, "sent_bytes": self.sent_bytes,
+                  "ratio": self.raw_bytes / self.sent_bytes if self.sent_bytes else 1.0,
+                  "error": self.error / self.count if self.count else 0.0}
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.error = 0.0
+        self.count = 0
+        return report
@@ -0,0 +1,111 @@
+import os
+
+import torch
+import torch.nn as nn
+
+import src.Log
+
+
+def cpu_quota():
+    """CPUs granted by the cgroup CPU quota of the container, None without a quota."""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as file:
+            quota, period = file.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as file:
+            quota = int(file.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as file:
+            period = int(file.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpus(text):
+    """CPU ids of a list such as "0-3,8"."""
+    cpus = []
+    for part in str(text).split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return cpus
+
+
+def layer_value(options, key, layer_id, default):
+    # Every option is one value for all layers, or a list with one value per layer
+    value = options.get(key, default)
+    if isinstance(value, list):
+        return value[layer_id - 1] if layer_id - 1 < len(value) else default
+    return value
+
+
+def plan(options, layer_id, slot=None):
+    """Threads, CPU set and memory format of a client of `layer_id`, None without `options`.
+
+    `slot` is (index, count) of this client among the processes started together on one machine; with
+    `affinity: auto` each of them is pinned to its own share of the CPUs. `threads: auto` uses the CPU
+    quota of the container, or the CPUs the client may run on without a quota.
+    """
+    if not options:
+        return None
+    cpus = available_cpus()
+    affinity = layer_value(options, "affinity", layer_id, "auto")
+    if affinity == "auto":
+        if slot:
+            index, count = slot
+            if count <= len(cpus):
+                cpus = cpus[index * len(cpus) // count:(index + 1) * len(cpus) // count]
+            else:
+                cpus = [cpus[index % len(cpus)]]
+        else:
+            affinity = None
+    elif affinity in (None, "none"):
+        affinity = None
+    else:
+        cpus = parse_cpus(affinity)
+
+    threads = layer_value(options, "threads", layer_id, "auto")
+    if threads == "auto":
+        quota = cpu_quota()
+        threads = len(cpus) if quota is None else max(1, min(len(cpus), int(quota)))
+    return {"threads": int(threads), "interop_threads": int(layer_value(options, "interop-threads", layer_id, 1)),
+            "affinity": cpus if affinity is not None else None,
+            "channels_last": bool(layer_value(options, "channels-last", layer_id, False))}
+
+
+def apply(settings):
+    """Pin this process and size the thread pools of torch, returns `settings`."""
+    if settings is None:
+        return None
+    if settings["affinity"] is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, settings["affinity"])
+    torch.set_num_threads(settings["threads"])
+    if torch.get_num_interop_threads() != settings["interop_threads"]:
+        try:
+            torch.set_num_interop_threads(settings["interop_threads"])
+        except RuntimeError:
+            # Only possible before the first inter-op parallel work of the process
+            settings["interop_threads"] = torch.get_num_interop_threads()
+    src.Log.print_with_color(f"Compute: {settings['threads']} threads, {settings['interop_threads']} inter-op "
+                             f"threads, CPUs {settings['affinity'] or 'not pinned'}, "
+                             f"channels_last {settings['channels_last']}", "green")
+    return settings
+
+
+def set_memory_format(model, settings):
+    """Move a stage with convolutions to channels_last when `settings` ask for it."""
+    if settings and settings["channels_last"] and any(isinstance(layer, nn.Conv2d) for layer in model.modules()):
+        model.to(memory_format=torch.channels_last)
+    return model
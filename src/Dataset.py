@@ -0,0 +1,83 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+CIFAR10_MEAN = (0.4914, 0.4822, 0.4465)
+CIFAR10_STD = (0.2023, 0.1994, 0.2010)
+
+
+class SyntheticCIFAR10(torch.utils.data.Dataset):
+    """Random uint8 images with the shape, `data`/`targets` layout and transforms of torchvision's CIFAR10.
+
+    Labels cycle through the 10 classes, so every label has `size` / 10 samples.
+    """
+
+    def __init__(self, size=50000, transform=None, seed=0):
+        self.data = np.random.default_rng(seed).integers(0, 256, size=(size, 32, 32, 3), dtype=np.uint8)
+        self.targets = [index % 10 for index in range(size)]
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        image = Image.fromarray(self.data[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+
+class TensorLoader:
+    """Batches of a uint8 NHWC image array kept in memory, augmented a whole batch at a time.
+
+    Same augmentation as RandomCrop(32, padding=4) + RandomHorizontalFlip + ToTensor + Normalize,
+    without per-sample PIL work.
+    """
+
+    def __init__(self, images, labels, batch_size, shuffle=True, augment=True, padding=4,
+                 mean=CIFAR10_MEAN, std=CIFAR10_STD):
+        self.images = torch.from_numpy(np.ascontiguousarray(images))
+        self.labels = torch.as_tensor(labels, dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.padding = padding
+
+        # Normalize((x / 255 - mean) / std) folded into one multiply-add
+        std = torch.tensor(std).view(1, -1, 1, 1)
+        self.scale = 1 / (255 * std)
+        self.shift = -torch.tensor(mean).view(1, -1, 1, 1) / std
+
+    def __len__(self):
+        return math.ceil(len(self.labels) / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.labels))
+        else:
+            order = torch.arange(len(self.labels))
+
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            images = self.images[indices]
+            if self.augment:
+                images = self.random_crop_flip(images)
+            images = images.permute(0, 3, 1, 2).float().mul_(self.scale).add_(self.shift)
+            yield images.contiguous(), self.labels[indices]
+
+    def random_crop_flip(self, images):
+        n, height, width, _ = images.shape
+        padded = F.pad(images, (0, 0, self.padding, self.padding, self.padding, self.padding))
+
+        top = torch.randint(0, 2 * self.padding + 1, (n, 1))
+        left = torch.randint(0, 2 * self.padding + 1, (n, 1))
+        rows = top + torch.arange(height)
+        cols = left + torch.arange(width)
+        # Mirror the column index of flipped samples instead of flipping afterwards
+        flip = torch.rand(n, 1) < 0.5
+        cols = torch.where(flip, cols.flip(1), cols)
+
+        return padded[torch.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
@@ -0,0 +1,146 @@
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import src.Log
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROUND_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Queues named after a client id are counted together
+CLIENT_SUFFIX = re.compile(r"_[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+class Metric:
+    """Values of one metric per label set, rendered in the Prometheus text format."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        with self.lock:
+            return [(f"{self.name}{self.format_labels(key)}", value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{sample} {value}" for sample, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            counts, _, _ = entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket{self.format_labels(key, [('le', bound)])}", bucket_count))
+                samples.append((f"{self.name}_bucket{self.format_labels(key, [('le', '+Inf')])}", count))
+                samples.append((f"{self.name}_sum{self.format_labels(key)}", total))
+                samples.append((f"{self.name}_count{self.format_labels(key)}", count))
+        return samples
+
+
+REGISTRY = []
+
+MESSAGES = Counter("split_messages_total", "Messages published and received, by queue.", ["queue", "direction"])
+BYTES = Counter("split_bytes_total", "Serialized message bytes sent and received.", ["direction"])
+SERIALIZATION = Histogram("split_serialization_seconds", "Time to serialize or deserialize a message.",
+                          ["operation"])
+STEP = Histogram("split_step_seconds", "Forward and backward time of a micro-batch.", ["phase"])
+IN_FLIGHT = Gauge("split_in_flight_micro_batches", "Micro-batches forwarded and waiting for their gradient.")
+HELD_BYTES = Gauge("split_held_bytes", "Activation memory kept for the backward of in-flight micro-batches.")
+LOSS = Gauge("split_loss", "Loss of the last micro-batch on the last layer.")
+ROUND = Histogram("split_round_seconds", "Time from START to the last UPDATE of a training round.",
+                  buckets=ROUND_BUCKETS)
+
+
+def queue_family(queue):
+    return CLIENT_SUFFIX.sub("", queue)
+
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(config, offset=0):
+    """Serve /metrics on a background thread when `metrics.enable` is set, on `metrics.port` + `offset`."""
+    options = config.get("metrics") or {}
+    if not options.get("enable", False):
+        return None
+    port = options.get("port", 9100) + offset
+    try:
+        server = ThreadingHTTPServer((options.get("address", "0.0.0.0"), port), MetricsHandler)
+    except OSError as e:
+        src.Log.print_with_color(f"Metrics endpoint not started on port {port}: {e}", "yellow")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    src.Log.print_with_color(f"Serving metrics on port {port}", "green")
+    return server
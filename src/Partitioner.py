@@ -0,0 +1,84 @@
+import numpy as np
+
+# Training time of a layer over its forward time, for profiles without backward times
+TRAINING_TIME_RATE = 3
+
+
+def layer_times(profile):
+    """Training time (ns) of each layer of a client profile."""
+    forward = profile["forward"]
+    backward = profile.get("backward")
+    if backward is None:
+        return [t * (TRAINING_TIME_RATE + 1) for t in forward]
+    return [f + b for f, b in zip(forward, backward)]
+
+
+def fit_profile(profile, start, end, measured):
+    """`profile` scaled so that its layers [start, end) take `measured` ns, as measured on the client."""
+    times = layer_times(profile)
+    scale = measured / max(sum(times[start:end]), 1e-9)
+    return {"forward": [t * scale for t in times], "backward": [0.0] * len(times),
+            "output_bytes": profile["output_bytes"], "parameters": profile.get("parameters")}
+
+
+def stage_timer(stage_profiles, output_bytes, bandwidths=None, default_bandwidth=None):
+    """Function (k, start, end) returning the time (ns) of stage k running layers [start, end)."""
+    num_layers = len(output_bytes)
+    # Prefix sums of the layer times of every client: the time of layers [start, end) is sums[end] - sums[start]
+    prefix = [[np.concatenate(([0.0], np.cumsum(layer_times(profile)))) for profile in profiles]
+              for profiles in stage_profiles]
+
+    def stage_time(k, start, end):
+        sent = (output_bytes[end - 1] if end < num_layers else 0) + (output_bytes[start - 1] if start > 0 else 0)
+        throughput = 0.0
+        for i, sums in enumerate(prefix[k]):
+            bandwidth = bandwidths[k][i] if bandwidths and bandwidths[k][i] else default_bandwidth
+            client_time = sums[end] - sums[start] + (sent * 1e9 / bandwidth if bandwidth else 0)
+            throughput += 1 / max(client_time, 1e-9)
+        return 1 / throughput
+
+    return stage_time
+
+
+def partition(stage_profiles, output_bytes, bandwidths=None, default_bandwidth=None):
+    """Cut layers that minimize the time of the slowest stage.
+
+    `stage_profiles[k]` holds the profiles of the clients of stage k and `bandwidths[k]` their measured
+    bandwidth in bytes/s (None when unknown, then `default_bandwidth` is used, or transfers are not counted).
+    A stage shares its micro-batches between its clients. Each client sends the activation at the end of its
+    layers and the gradient at their start. When profiles count the parameters of each layer, every stage
+    gets at least one layer with parameters. Returns (cut_layers, time of the slowest stage in ns).
+    """
+    num_layers = len(output_bytes)
+    num_stages = len(stage_profiles)
+    if num_stages > num_layers:
+        raise ValueError(f"Cannot split {num_layers} layers over {num_stages} stages.")
+
+    stage_time = stage_timer(stage_profiles, output_bytes, bandwidths, default_bandwidth)
+    parameters = stage_profiles[0][0].get("parameters")
+    parameter_sums = np.concatenate(([0], np.cumsum(parameters))) if parameters else None
+
+    # best[k][end]: slowest stage time when stages 0..k-1 run layers [0, end)
+    best = np.full((num_stages + 1, num_layers + 1), np.inf)
+    choice = np.zeros((num_stages + 1, num_layers + 1), dtype=int)
+    best[0][0] = 0
+    for k in range(1, num_stages + 1):
+        for end in range(k, num_layers - (num_stages - k) + 1):
+            for start in range(k - 1, end):
+                if best[k - 1][start] == np.inf:
+                    continue
+                if parameter_sums is not None and parameter_sums[end] == parameter_sums[start]:
+                    continue
+                t = max(best[k - 1][start], stage_time(k - 1, start, end))
+                if t < best[k][end]:
+                    best[k][end] = t
+                    choice[k][end] = start
+
+    if best[num_stages][num_layers] == np.inf:
+        raise ValueError(f"Cannot split the layers with parameters over {num_stages} stages.")
+    cut_layers = []
+    end = num_layers
+    for k in range(num_stages, 1, -1):
+        end = int(choice[k][end])
+        cut_layers.insert(0, end)
+    return cut_layers, float(best[num_stages][num_layers])
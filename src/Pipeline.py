@@ -0,0 +1,92 @@
+import math
+import time
+
+POLICIES = ["1f1b", "gpipe", "adaptive"]
+
+
+class Pipeline:
+    """Micro-batches in flight on one stage, and when the stage may start another forward.
+
+    1f1b: at most `window` micro-batches in flight, one optimizer step after every backward.
+    gpipe: forward `window` micro-batches, then drain them and step once on the accumulated gradients.
+    adaptive: like 1f1b, with the window sized from the measured round trip time of a micro-batch
+    and the compute time of this stage, up to `max_window`.
+    """
+
+    def __init__(self, policy="1f1b", window=4, max_window=16):
+        if policy not in POLICIES:
+            raise ValueError(f"Pipeline policy '{policy}' is not supported, use one of {POLICIES}.")
+        self.policy = policy
+        self.window = max(window, 1)
+        self.max_window = max(max_window, self.window)
+
+        # data_id -> (time sent, forward time)
+        self.in_flight = {}
+        self.draining = False
+        self.accumulated = 0
+
+        self.rtt = None
+        self.compute = None
+        self.windows = []
+        self.bubble_time = 0
+        self.start_time = time.perf_counter_ns()
+
+    def can_forward(self):
+        if self.policy == "gpipe":
+            return not self.draining
+        return len(self.in_flight) < self.window
+
+    def forwarded(self, data_id, forward_time):
+        self.in_flight[data_id] = (time.perf_counter_ns(), forward_time)
+        if self.policy == "gpipe" and len(self.in_flight) >= self.window:
+            self.draining = True
+
+    def backwarded(self, data_id, backward_time, accumulated=True):
+        """Record the backward of `data_id`, return True when the optimizer should step.
+
+        `accumulated` is False when the gradients of the micro-batch were dropped.
+        """
+        sent, forward_time = self.in_flight.pop(data_id)
+        if accumulated:
+            self.accumulated += 1
+
+        if self.policy == "adaptive":
+            rtt = time.perf_counter_ns() - sent - backward_time
+            compute = forward_time + backward_time
+            self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
+            self.compute = compute if self.compute is None else 0.8 * self.compute + 0.2 * compute
+            # Enough micro-batches to keep computing while one of them makes the round trip
+            self.window = min(self.max_window, max(1, math.ceil(self.rtt / max(self.compute, 1))))
+            self.windows.append(self.window)
+
+        if self.policy != "gpipe":
+            return True
+        if not self.in_flight:
+            self.draining = False
+            return True
+        return False
+
+    def step(self, optimizer):
+        # Gradients of several micro-batches were summed, average them
+        if self.accumulated > 1:
+            for group in optimizer.param_groups:
+                for param in group["params"]:
+                    if param.grad is not None:
+                        param.grad.div_(self.accumulated)
+        optimizer.step()
+        optimizer.zero_grad()
+        self.accumulated = 0
+
+    def wait(self, elapsed):
+        """Time spent waiting for a micro-batch or a gradient, the pipeline bubble of this stage."""
+        self.bubble_time += elapsed
+
+    def report(self):
+        report = {"policy": self.policy, "bubble_time": self.bubble_time,
+                  "total_time": time.perf_counter_ns() - self.start_time}
+        # Only the adaptive window is measured, the others are the configured value
+        if self.policy == "adaptive":
+            report["window"] = sum(self.windows) / len(self.windows) if self.windows else self.window
+        else:
+            report["fixed_window"] = self.window
+        return report
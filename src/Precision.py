@@ -0,0 +1,82 @@
+import contextlib
+
+import torch
+
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+class Precision:
+    """Autocast of one layer, and the loss scale of fp16 training.
+
+    bf16 has the exponent range of fp32 and needs no loss scaling. With fp16, the last layer multiplies
+    the loss by `scale` and every gradient sent upstream carries the scale it was computed with. Each
+    layer divides its parameter gradients by that scale, and drops them when one overflowed. The last
+    layer then halves the scale, and doubles it again after `growth_interval` steps without overflow.
+    """
+
+    def __init__(self, precision="fp32", device="cpu", init_scale=2.0 ** 16, growth_interval=2000):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Precision '{precision}' is not supported, use one of {list(PRECISIONS)}.")
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        self.device_type = torch.device(device).type
+        self.scale = init_scale if precision == "fp16" else 1.0
+        self.growth_interval = growth_interval
+        self.good_steps = 0
+        self.skipped = 0
+
+    def autocast(self):
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def boundary(self, tensor):
+        """`tensor` as sent to another layer, in the reduced dtype."""
+        if self.dtype is None or not tensor.is_floating_point():
+            return tensor
+        return tensor.to(self.dtype)
+
+    def backward(self, model, backward, scale=1.0):
+        """Run `backward()`, whose gradients come from a loss multiplied by `scale`, and unscale them.
+
+        Returns False when one of the gradients of this micro-batch is not finite: they are dropped, and
+        those accumulated by earlier micro-batches are kept as they were.
+        """
+        if scale == 1.0:
+            backward()
+            return True
+        params = [param for param in model.parameters() if param.requires_grad]
+        # Earlier gradients are set aside, so that this micro-batch's can be checked on their own
+        accumulated = [param.grad for param in params]
+        for param in params:
+            param.grad = None
+        backward()
+        grads = [param.grad for param in params]
+        finite = all(torch.isfinite(grad).all() for grad in grads if grad is not None)
+        for param, grad, previous in zip(params, grads, accumulated):
+            if not finite or grad is None:
+                param.grad = previous
+            else:
+                grad.div_(scale)
+                param.grad = grad if previous is None else previous.add_(grad)
+        if not finite:
+            self.skipped += 1
+        return finite
+
+    def update(self, finite):
+        """Adjust the loss scale after a backward of the last layer."""
+        if self.dtype is not torch.float16:
+            return
+        if not finite:
+            self.scale /= 2
+            self.good_steps = 0
+            return
+        self.good_steps += 1
+        if self.good_steps >= self.growth_interval:
+            self.scale *= 2
+            self.good_steps = 0
+
+    def report(self):
+        report = {"precision": self.precision, "scale": self.scale, "skipped": self.skipped}
+        self.skipped = 0
+        return report
@@ -0,0 +1,132 @@
+import json
+import time
+
+import numpy as np
+import torch
+
+import src.Model
+
+PERCENTILES = [50, 90, 99]
+
+
+def synchronize(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+
+
+def profile_model(model_name, batch_size=128, device="cpu", rounds=10, warmup=2, input_shape=(3, 32, 32)):
+    """Per-layer profile of `model_name` training on a random batch.
+
+    Forward and backward times (ns) are the median over `rounds` after `warmup` rounds, percentiles are in
+    "forward_percentiles" and "backward_percentiles". "activation_memory" is what each layer keeps for its
+    backward, "output_bytes" the size of its output, sent over the link when cutting after that layer, and
+    "parameters" its number of parameters.
+    """
+    layers = list(src.Model.build_stage(model_name).to(device))
+    for layer in layers:
+        layer.train()
+
+    data_input = torch.randn(batch_size, *input_shape, device=device)
+    forward_time = []
+    backward_time = []
+    activation_memory = []
+    output_bytes = []
+    for i in range(warmup + rounds):
+        record = i >= warmup
+        forward_times = []
+        backward_times = []
+
+        # Every layer gets its own graph, so that its backward can be timed alone
+        inputs = []
+        outputs = []
+        data = data_input
+        for j, layer in enumerate(layers):
+            data = data.detach().requires_grad_(j > 0)
+            saved = {}
+
+            def pack(tensor):
+                saved[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+                return tensor
+
+            synchronize(device)
+            start = time.perf_counter_ns()
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                output = layer(data)
+            synchronize(device)
+            forward_times.append(time.perf_counter_ns() - start)
+
+            if i == 0:
+                activation_memory.append(sum(saved.values()))
+                output_bytes.append(output.nelement() * output.element_size())
+            inputs.append(data)
+            outputs.append(output)
+            data = output
+
+        gradient = torch.ones_like(outputs[-1])
+        for j in reversed(range(len(layers))):
+            start = time.perf_counter_ns()
+            if outputs[j].requires_grad:
+                outputs[j].backward(gradient)
+            synchronize(device)
+            backward_times.insert(0, time.perf_counter_ns() - start)
+            gradient = inputs[j].grad
+
+        for layer in layers:
+            layer.zero_grad(set_to_none=True)
+        if record:
+            forward_time.append(forward_times)
+            backward_time.append(backward_times)
+
+    forward_time = np.array(forward_time)
+    backward_time = np.array(backward_time)
+    return {"model": model_name, "batch_size": batch_size, "device": str(device), "rounds": rounds,
+            "forward": np.median(forward_time, axis=0).tolist(),
+            "backward": np.median(backward_time, axis=0).tolist(),
+            "forward_percentiles": {f"p{q}": np.percentile(forward_time, q, axis=0).tolist() for q in PERCENTILES},
+            "backward_percentiles": {f"p{q}": np.percentile(backward_time, q, axis=0).tolist() for q in PERCENTILES},
+            "activation_memory": activation_memory,
+            "output_bytes": output_bytes,
+            "parameters": [sum(param.numel() for param in layer.parameters()) for layer in layers]}
+
+
+def probe_link(transport, queue, sizes=(1024, 2 ** 20, 2 ** 22), rounds=5):
+    """Latency (s) and throughput (bytes/s) of `transport`, from round trips of tensors through `queue`."""
+    transport.declare(queue)
+    results = {}
+    for size in sizes:
+        message = {"data": torch.zeros(size // 4, dtype=torch.float32)}
+        times = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            transport.publish(queue, message)
+            transport.receive([queue])
+            times.append(time.perf_counter() - start)
+        results[size] = float(np.median(times))
+    transport.cancel()
+
+    # Sending and taking back a message crosses the link twice
+    latency = results[min(sizes)] / 2
+    bandwidth = 2 * max(sizes) / results[max(sizes)]
+    return {"latency": latency, "bandwidth": bandwidth, "round_trip": results}
+
+
+def register_profile(client, config, model_name):
+    """Fields of the REGISTER message of `client` with which the server chooses the cut layers.
+
+    With `partition.auto`, the profile of `model_name` on the device of the client and the bandwidth of its
+    link, otherwise nothing.
+    """
+    if not (config["server"].get("partition") or {}).get("auto"):
+        return {}
+    return {"profile": profile_model(model_name, config["learning"]["batch-size"], client.device),
+            "bandwidth": probe_link(client.transport, f'probe_{client.client_id}')["bandwidth"]}
+
+
+def save_profile(profile, path):
+    with open(path, "w") as file:
+        json.dump(profile, file, indent=2)
+
+
+def load_profile(path):
+    with open(path, "r") as file:
+        return json.load(file)
@@ -1,37 +1,45 @@
-import time
-import pickle
-import pika
 import random
 import torch
 import torchvision
 import torchvision.transforms as transforms
 
-from torch import nn
-from collections import defaultdict
-
+import src.Compute
 import src.Log
 import src.Model
+import src.Utils
+from src.Compression import Compressor, apply_delta, state_dict_delta
+from src.Dataset import TensorLoader
 
 
 class RpcClient:
-    def __init__(self, client_id, layer_id, address, username, password, train_func, device):
+    def __init__(self, client_id, layer_id, transport, train_func, device, train_set=None, slot=None):
         self.client_id = client_id
         self.layer_id = layer_id
-        self.address = address
-        self.username = username
-        self.password = password
+        self.transport = transport
         self.train_func = train_func
         self.device = device
+        # (index, count) of this client among the processes started together on this machine
+        self.slot = slot
+        self.compute = None
 
-        self.channel = None
-        self.connection = None
         self.response = None
         self.model = None
-        self.connect()
-
-        self.train_set = None
+        self.layers = None
+        self.train_loader = None
+        self.train_sampler = None
+        self.loader_options = None
+
+        # Last parameters received from the server, uploads are deltas against them
+        self.parameter_version = None
+        self.parameter_base = None
+        self.delta_compressor = None
+
+        self.train_set = train_set
+        self.test_set = None
         self.label_to_indices = None
-        if self.layer_id == 1:
+        if self.layer_id == 1 and train_set is not None:
+            self.label_to_indices = src.Utils.label_to_indices(train_set.targets)
+        elif self.layer_id == 1:
             # Read and load dataset
             transform_train = transforms.Compose([
                 transforms.RandomCrop(32, padding=4),
@@ -43,22 +51,22 @@ class RpcClient:
             self.train_set = torchvision.datasets.CIFAR10(
                 root='./data', train=True, download=True, transform=transform_train)
 
-            self.label_to_indices = defaultdict(list)
-            for idx, (_, label) in enumerate(self.train_set):
-                self.label_to_indices[label].append(idx)
+            # Built from the targets only, decoding every image just to read its label is slow
+            self.label_to_indices = src.Utils.label_to_indices(self.train_set.targets,
+                                                               './data/cifar10_train_label_index.npz')
 
     def wait_response(self):
         status = True
         reply_queue_name = f'reply_{self.client_id}'
-        self.channel.queue_declare(reply_queue_name, durable=False)
+        self.transport.declare(reply_queue_name)
         while status:
-            method_frame, header_frame, body = self.channel.basic_get(queue=reply_queue_name, auto_ack=True)
-            if body:
-                status = self.response_message(body)
-            time.sleep(0.5)
+            _, message = self.transport.receive([reply_queue_name])
+            # Hand the reply queue over to the Scheduler while training
+            self.transport.cancel()
+            status = self.response_message(message)
 
-    def response_message(self, body):
-        self.response = pickle.loads(body)
+    def response_message(self, message):
+        self.response = message
         src.Log.print_with_color(f"[<<<] Client received: {self.response['message']}", "blue")
         action = self.response["action"]
         state_dict = self.response["parameters"]
@@ -69,28 +77,49 @@ class RpcClient:
             label_count = self.response['label_count']
             num_layers = self.response['num_layers']
 
-            if self.model is None:
-                klass = getattr(src.Model, model_name)
-                full_model = klass()
-
+            if self.model is None or cut_layers != self.layers:
+                # First round, or the server moved the cut layers: the parameters of the new layers come with START
+                self.layers = cut_layers
+                self.parameter_version = None
+                self.parameter_base = None
+                self.delta_compressor = None
+                self.compute = src.Compute.apply(src.Compute.plan(self.response.get("compute"), self.layer_id,
+                                                                  self.slot))
                 if cut_layers:
-                    from_layer = cut_layers[0]
-                    to_layer = cut_layers[1]
-                    if to_layer == -1:
-                        self.model = nn.Sequential(*nn.ModuleList(full_model.children())[from_layer:])
-                    else:
-                        self.model = nn.Sequential(*nn.ModuleList(full_model.children())[from_layer:to_layer])
+                    # Only the layers of this client are built
+                    self.model = src.Model.build_stage(model_name, cut_layers[0], cut_layers[1])
 
                 self.model.to(self.device)
+                src.Compute.set_memory_format(self.model, self.compute)
+                src.Model.compile_stage(self.model, self.response.get("compile"))
 
             # Read parameters and load to model
+            delta = self.response.get("delta")
+            if delta is not None:
+                if self.parameter_version == self.response["base_version"]:
+                    state_dict = apply_delta(self.parameter_base, delta)
+                else:
+                    src.Log.print_with_color(f"Parameters version {self.response['base_version']} is not cached, "
+                                             f"keeping the local model.", "yellow")
+                    self.parameter_version = None
+                    self.parameter_base = None
             if state_dict:
                 self.model.load_state_dict(state_dict)
+                if self.response.get("version") is not None:
+                    self.parameter_version = self.response["version"]
+                    self.parameter_base = state_dict
 
             batch_size = self.response["batch_size"]
             lr = self.response["lr"]
             momentum = self.response["momentum"]
             control_count = self.response["control_count"]
+            compression = self.response.get("compression")
+            recompute = self.response.get("recompute", False)
+            data_pipeline = self.response.get("data_pipeline", "torchvision")
+            data_loader = self.response.get("data_loader") or {}
+            pipeline = self.response.get("pipeline")
+            inference = self.response.get("inference")
+            precision = self.response.get("precision", "fp32")
 
             # Start training
             if self.layer_id == 1:
@@ -98,12 +127,22 @@ class RpcClient:
                 for label, count in enumerate(label_count):
                     selected_indices.extend(random.sample(self.label_to_indices[label], count))
 
-                subset = torch.utils.data.Subset(self.train_set, selected_indices)
-                train_loader = torch.utils.data.DataLoader(subset, batch_size=batch_size, shuffle=True)
-
-                result, size = self.train_func(self.model, lr, momentum, num_layers, control_count, train_loader)
+                if data_pipeline == "tensor":
+                    train_loader = TensorLoader(self.train_set.data[selected_indices],
+                                                [self.train_set.targets[idx] for idx in selected_indices],
+                                                batch_size)
+                else:
+                    train_loader = self.get_train_loader(selected_indices, batch_size, data_loader)
+
+                test_loader = self.get_test_loader(inference, batch_size) if inference else None
+                result, size, stats = self.train_func(self.model, lr, momentum, num_layers, control_count,
+                                                      train_loader, compression, recompute, pipeline, test_loader,
+                                                      inference, precision)
             else:
-                result, size = self.train_func(self.model, lr, momentum, num_layers, control_count)
+                result, size, stats = self.train_func(self.model, lr, momentum, num_layers, control_count,
+                                                      compression=compression, recompute=recompute,
+                                                      pipeline=pipeline, inference=inference, precision=precision)
+            stats["compute"] = self.compute
 
             # Stop training, then send parameters to server
             model_state_dict = self.model.state_dict()
@@ -111,26 +150,54 @@ class RpcClient:
                 for key in model_state_dict:
                     model_state_dict[key] = model_state_dict[key].to('cpu')
             data = {"action": "UPDATE", "client_id": self.client_id, "layer_id": self.layer_id,
-                    "result": result, "size": size,
-                    "message": "Sent parameters to Server", "parameters": model_state_dict}
+                    "result": result, "size": size, "stats": stats,
+                    "message": "Sent parameters to Server", "parameters": model_state_dict,
+                    "version": self.parameter_version}
+            parameter_delta = self.response.get("parameter_delta") or {}
+            mode = parameter_delta.get("mode", "none")
+            if mode != "none" and self.parameter_base is not None:
+                if self.delta_compressor is None or self.delta_compressor.mode != mode:
+                    self.delta_compressor = Compressor(mode, parameter_delta.get("topk-ratio", 0.01))
+                data["parameters"] = None
+                data["delta"] = state_dict_delta(self.delta_compressor, model_state_dict, self.parameter_base)
             src.Log.print_with_color("[>>>] Client sent parameters to server", "red")
             self.send_to_server(data)
             return True
         elif action == "STOP":
             return False
 
-    def connect(self):
-        credentials = pika.PlainCredentials(self.username, self.password)
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.address, 5672, '/', credentials))
-        self.channel = self.connection.channel()
+    def get_test_loader(self, inference, batch_size):
+        # Held-out samples run through the split model after training
+        if self.test_set is None:
+            self.test_set = torchvision.datasets.CIFAR10(root='./data', train=False, download=True)
+        samples = min(inference.get("samples", 1000), len(self.test_set.targets))
+        indices = random.sample(range(len(self.test_set.targets)), samples)
+        return TensorLoader(self.test_set.data[indices], [self.test_set.targets[idx] for idx in indices],
+                            inference.get("batch-size") or batch_size, shuffle=False, augment=False)
+
+    def get_train_loader(self, selected_indices, batch_size, options):
+        # The loader is kept across rounds so that persistent workers are started only once,
+        # each round only swaps the indices of its sampler
+        options = dict(options, batch_size=batch_size)
+        if self.train_loader is None or options != self.loader_options:
+            num_workers = options.get("num-workers", 0)
+            self.train_sampler = torch.utils.data.SubsetRandomSampler(selected_indices)
+            self.train_loader = torch.utils.data.DataLoader(
+                self.train_set, batch_size=batch_size, sampler=self.train_sampler, num_workers=num_workers,
+                prefetch_factor=options.get("prefetch-factor", 2) if num_workers > 0 else None,
+                persistent_workers=options.get("persistent-workers", True) and num_workers > 0,
+                pin_memory=options.get("pin-memory", False) and self.device != "cpu")
+            self.loader_options = options
+        else:
+            self.train_sampler.indices = selected_indices
+        return self.train_loader
 
     def send_to_server(self, message):
-        self.connect()
+        # The connection may have idled out while training, reconnect before sending
+        self.transport.connect()
         self.response = None
 
-        self.channel.queue_declare('rpc_queue', durable=False)
-        self.channel.basic_publish(exchange='',
-                                   routing_key='rpc_queue',
-                                   body=pickle.dumps(message))
+        self.transport.declare('rpc_queue')
+        self.transport.publish('rpc_queue', message)
 
         return self.response
@@ -1,296 +1,495 @@
 import time
 import uuid
-import pickle
 from tqdm import tqdm
 
+import numpy as np
 import torch
 import torch.optim as optim
 import torch.nn as nn
 
 import src.Log
+import src.Metrics
+import src.Model
+from src.Compression import Compressor, decompress, link_mode
+from src.Pipeline import Pipeline
+from src.Precision import Precision
+from src.Trace import Tracer
+from src.Transport import AsyncTransport
 
 
 class Scheduler:
-    def __init__(self, client_id, layer_id, channel, device, event_time=False):
+    def __init__(self, client_id, layer_id, transport, device, event_time=False):
         self.client_id = client_id
         self.layer_id = layer_id
-        self.channel = channel
+        self.transport = transport
         self.device = device
+        # With background I/O threads, compression and decoding run there instead of in the training loop
+        self.async_io = isinstance(transport, AsyncTransport)
+        if self.async_io:
+            self.transport.encode = self.encode_message
+            self.transport.decode = self.decode_message
         self.data_count = 0
-
-        self.event_time = event_time
-        self.time_event = []
-
-    def send_intermediate_output(self, data_id, output, labels, trace, test=False):
+        self.forward_compressor = Compressor(error_feedback=False)
+        self.backward_compressor = Compressor(error_feedback=False)
+        self.recompute = False
+        self.precision = Precision(device=device)
+        self.step_time = {"forward": [], "backward": []}
+        self.held_bytes = 0
+        self.peak_held_bytes = 0
+        # Evaluation copy of the model for the held-out batches of a round
+        self.fuse = False
+        self.eval_model = None
+
+        # Named spans of every micro-batch, uploaded to the server with UPDATE
+        self.tracer = Tracer(event_time)
+
+    def send_intermediate_output(self, data_id, output, labels, trace, test=False, window_end=False):
         forward_queue_name = f'intermediate_queue_{self.layer_id}'
-        self.channel.queue_declare(forward_queue_name, durable=False)
+        self.transport.declare(forward_queue_name)
 
+        # `window_end` marks the last micro-batch of a gpipe window of the first layer
         if trace:
             trace.append(self.client_id)
-            message = pickle.dumps(
-                {"data_id": data_id, "data": output.detach().cpu().numpy(), "label": labels, "trace": trace,
-                 "test": test}
-            )
+            message = {"data_id": data_id, "data": self.precision.boundary(output.detach()), "label": labels,
+                       "trace": trace, "test": test, "window_end": window_end}
         else:
-            message = pickle.dumps(
-                {"data_id": data_id, "data": output.detach().cpu().numpy(), "label": labels, "trace": [self.client_id],
-                 "test": test}
-            )
-
-        self.channel.basic_publish(
-            exchange='',
-            routing_key=forward_queue_name,
-            body=message
-        )
-
-    def send_gradient(self, data_id, gradient, trace):
+            message = {"data_id": data_id, "data": self.precision.boundary(output.detach()), "label": labels,
+                       "trace": [self.client_id], "test": test, "window_end": window_end}
+
+        self.publish(forward_queue_name, message)
+
+    def send_gradient(self, data_id, gradient, trace, scale=1.0):
         to_client_id = trace[-1]
         trace.pop(-1)
         backward_queue_name = f'gradient_queue_{self.layer_id - 1}_{to_client_id}'
-        self.channel.queue_declare(queue=backward_queue_name, durable=False)
+        self.transport.declare(backward_queue_name)
 
-        message = pickle.dumps(
-            {"data_id": data_id, "data": gradient.detach().cpu().numpy(), "trace": trace, "test": False})
+        # `scale` is the loss scale the gradient was computed with
+        message = {"data_id": data_id, "data": self.precision.boundary(gradient.detach()), "trace": trace,
+                   "scale": scale, "test": False}
 
-        self.channel.basic_publish(
-            exchange='',
-            routing_key=backward_queue_name,
-            body=message
-        )
+        self.publish(backward_queue_name, message)
 
     def send_validation(self, data_id, data, trace):
         to_client_id = trace[0]
         backward_queue_name = f'gradient_queue_1_{to_client_id}'
-        self.channel.queue_declare(queue=backward_queue_name, durable=False)
-
-        message = pickle.dumps({"data_id": data_id, "data": data, "trace": trace, "test": True})
-
-        self.channel.basic_publish(
-            exchange='',
-            routing_key=backward_queue_name,
-            body=message
-        )
+        self.transport.declare(backward_queue_name)
+
+        message = {"data_id": data_id, "data": data, "trace": trace, "test": True}
+
+        self.publish(backward_queue_name, message)
+
+    def encode_message(self, queue, message, prepare=None):
+        """Compress `message` and encode it with `prepare`, the one of the transport that publishes it."""
+        data_id = message.get("data_id")
+        with self.tracer.span("compress", data_id, queue=queue):
+            if queue.startswith("intermediate_queue"):
+                message["data"] = self.forward_compressor.compress(message["data"])
+            elif queue.startswith("gradient_queue") and not message["test"]:
+                message["data"] = self.backward_compressor.compress(message["data"])
+        with self.tracer.span("serialize", data_id, queue=queue):
+            return (prepare or self.transport.prepare)(message)
+
+    def decode_message(self, queue, message):
+        if queue.startswith("intermediate_queue") or queue.startswith("gradient_queue"):
+            with self.tracer.span("decompress", message.get("data_id"), queue=queue):
+                if isinstance(message["data"], (torch.Tensor, dict)):
+                    message["data"] = decompress(message["data"]).to(self.device)
+                if "label" in message:
+                    message["label"] = message["label"].to(self.device)
+        return message
+
+    def publish(self, queue, message):
+        data_id = message.get("data_id")
+        if not self.async_io:
+            message = self.encode_message(queue, message)
+        with self.tracer.span("publish", data_id, queue=queue):
+            self.transport.publish(queue, message)
+
+    def receive(self, queues, timeout=None):
+        # queue_wait is the time blocked until a message arrives, dequeue also covers decoding it
+        with self.tracer.span("dequeue") as dequeue:
+            with self.tracer.span("queue_wait") as queue_wait:
+                queue, message = self.transport.receive(queues, timeout)
+            if message is not None:
+                queue_wait.tag(message.get("data_id"))
+                dequeue.tag(message.get("data_id"))
+                if not self.async_io:
+                    message = self.decode_message(queue, message)
+        return queue, message
 
     def send_to_server(self, message):
-        self.channel.queue_declare('rpc_queue', durable=False)
-        self.channel.basic_publish(exchange='',
-                                   routing_key='rpc_queue',
-                                   body=pickle.dumps(message))
-
-    def train_on_first_layer(self, model, lr, momentum, control_count=5, train_loader=None):
+        self.transport.declare('rpc_queue')
+        self.transport.publish('rpc_queue', message)
+
+    def infer(self, model, test_loader, window):
+        """Run the held-out batches of `test_loader` through the split model, at most `window` in flight.
+
+        The last layer sends the predictions of every batch back here. Returns the labels, the
+        predictions and the throughput and latency of the whole pipeline.
+        """
+        prediction_queue_name = f'gradient_queue_1_{self.client_id}'
+        model = self.inference_model(model)
+        sent = {}
+        labels = []
+        predictions = []
+        latencies = []
+        data_iter = iter(test_loader)
+        end_data = False
+        start = time.perf_counter()
+        while not end_data or sent:
+            if not end_data and len(sent) < window:
+                try:
+                    test_data, test_labels = next(data_iter)
+                except StopIteration:
+                    end_data = True
+                    continue
+                data_id = uuid.uuid4()
+                # no_grad rather than inference_mode: the output may be moved to shared memory by the transport
+                with torch.no_grad(), self.precision.autocast(), self.tracer.span("inference", data_id):
+                    output = model(test_data.to(self.device))
+                sent[data_id] = (time.perf_counter(), test_labels)
+                self.send_intermediate_output(data_id, output, test_labels.to(self.device), None, test=True)
+                continue
+
+            _, received_data = self.receive([prediction_queue_name])
+            send_time, test_labels = sent.pop(received_data["data_id"])
+            latencies.append(time.perf_counter() - send_time)
+            labels.append(test_labels.numpy())
+            predictions.append(received_data["data"].cpu().numpy())
+        elapsed = time.perf_counter() - start
+
+        labels = np.concatenate(labels) if labels else np.array([])
+        predictions = np.concatenate(predictions) if predictions else np.array([])
+        report = {"samples": len(labels), "batches": len(latencies),
+                  "samples_per_s": len(labels) / elapsed if elapsed else 0.0,
+                  "latency": {f"p{q}": float(np.percentile(latencies, q)) if latencies else 0.0 for q in (50, 90, 99)}}
+        return labels, predictions, report
+
+    def train_on_stage(self, model, lr, momentum, pipeline, train_loader=None, test_loader=None):
+        """Training loop of the first and middle layers, `pipeline` decides when a forward may start."""
         optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
-        data_iter = iter(train_loader)
+        first_layer = self.layer_id == 1
 
+        forward_queue_name = None if first_layer else f'intermediate_queue_{self.layer_id - 1}'
         backward_queue_name = f'gradient_queue_{self.layer_id}_{self.client_id}'
-        self.channel.queue_declare(queue=backward_queue_name, durable=False)
-        self.channel.basic_qos(prefetch_count=10)
-        num_forward = 0
-        num_backward = 0
+        broadcast_queue_name = f'reply_{self.client_id}'
+        if forward_queue_name:
+            self.transport.declare(forward_queue_name)
+        self.transport.declare(backward_queue_name)
+        self.transport.set_prefetch(10)
+        data_iter = iter(train_loader) if first_layer else None
         end_data = False
         data_store = {}
 
         model.to(self.device)
-        with tqdm(total=len(train_loader), desc="Processing", unit="step") as pbar:
-            while True:
-                # Training model
-                model.train()
-                optimizer.zero_grad()
-                # Process gradient
-                method_frame, header_frame, body = self.channel.basic_get(queue=backward_queue_name, auto_ack=True)
-                if method_frame and body:
-                    if self.event_time:
-                        self.time_event.append(time.time())
-                    num_backward += 1
-                    received_data = pickle.loads(body)
-                    gradient_numpy = received_data["data"]
-                    gradient = torch.tensor(gradient_numpy).to(self.device)
-                    data_id = received_data["data_id"]
-
-                    data_input = data_store.pop(data_id)
-                    output = model(data_input)
-                    output.backward(gradient=gradient, retain_graph=True)
-                    optimizer.step()
-                    if self.event_time:
-                        self.time_event.append(time.time())
-                else:
-                    # speed control
-                    if len(data_store) > control_count:
-                        continue
-                    # Process forward message
-                    try:
-                        if self.event_time:
-                            self.time_event.append(time.time())
-                        training_data, labels = next(data_iter)
-                        training_data = training_data.to(self.device)
-                        data_id = uuid.uuid4()
-                        data_store[data_id] = training_data
-                        intermediate_output = model(training_data)
-                        intermediate_output = intermediate_output.detach().requires_grad_(True)
-
-                        # Send to next layers
-                        num_forward += 1
-                        self.data_count += 1
-                        # tqdm bar
-                        pbar.update(1)
-                        if self.event_time:
-                            self.time_event.append(time.time())
-
-                        self.send_intermediate_output(data_id, intermediate_output, labels, None)
-
-                    except StopIteration:
-                        end_data = True
-                if end_data and (num_forward == num_backward):
+        if first_layer:
+            pbar = tqdm(total=len(train_loader), desc="Processing", unit="step")
+        else:
+            print('Waiting for intermediate output. To exit press CTRL+C')
+        while True:
+            # Training model
+            model.train()
+            can_forward = pipeline.can_forward()
+            if first_layer:
+                if end_data and not data_store:
                     break
+                queues = [backward_queue_name]
+                # Block for a gradient only when no forward step is allowed
+                timeout = 0 if can_forward and not end_data else None
+            else:
+                # Process gradient first, then forward, then control messages
+                queues = [backward_queue_name] + ([forward_queue_name] if can_forward else []) + [
+                    broadcast_queue_name]
+                timeout = None
+
+            start = time.perf_counter_ns()
+            queue, received_data = self.receive(queues, timeout)
+            if queue != broadcast_queue_name:
+                pipeline.wait(time.perf_counter_ns() - start)
+
+            if queue == backward_queue_name:
+                gradient = received_data["data"]
+                data_id = received_data["data_id"]
+                scale = received_data.get("scale", 1.0)
+
+                with self.tracer.span("backward", data_id):
+                    gradient, finite = self.backward(model, data_store.pop(data_id), gradient, scale)
+                src.Metrics.IN_FLIGHT.set(len(data_store))
+                if pipeline.backwarded(data_id, self.step_time["backward"][-1], finite):
+                    self.optimizer_step(pipeline, optimizer, data_id)
+
+                if not first_layer:
+                    self.send_gradient(data_id, gradient, received_data["trace"], scale)
+            elif queue == broadcast_queue_name:
+                # Check training process
+                src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
+                if received_data["action"] == "PAUSE":
+                    return True
+            elif queue is None:
+                # Process forward message from the data loader
+                try:
+                    data_id = uuid.uuid4()
+                    with self.tracer.span("data_load", data_id):
+                        training_data, labels = next(data_iter)
+                    training_data = training_data.to(self.device, non_blocking=True)
+                    with self.tracer.span("forward", data_id):
+                        intermediate_output, data_store[data_id] = self.forward(model, training_data)
+                    intermediate_output = intermediate_output.detach().requires_grad_(True)
+                    pipeline.forwarded(data_id, self.step_time["forward"][-1])
+                    src.Metrics.IN_FLIGHT.set(len(data_store))
+
+                    # Send to next layers
+                    self.data_count += 1
+                    # tqdm bar
+                    pbar.update(1)
+
+                    self.send_intermediate_output(data_id, intermediate_output, labels, None,
+                                                  window_end=pipeline.policy == "gpipe" and pipeline.draining)
+
+                except StopIteration:
+                    end_data = True
+            else:
+                # Process forward message from the previous layer
+                trace = received_data["trace"]
+                data_id = received_data["data_id"]
+                test = received_data["test"]
+                labels = received_data["label"]
+
+                if test:
+                    # Held-out batch: forward only, nothing is kept for a backward
+                    with torch.no_grad(), self.precision.autocast(), self.tracer.span("inference", data_id):
+                        output = self.inference_model(model)(received_data["data"])
+                    self.send_intermediate_output(data_id, output, labels, trace, test)
+                    continue
 
-            notify_data = {"action": "NOTIFY", "client_id": self.client_id, "layer_id": self.layer_id,
-                           "message": "Finish training!", "validate": None}
+                intermediate_output = received_data["data"].requires_grad_(True)
+                with self.tracer.span("forward", data_id):
+                    output, data_store[data_id] = self.forward(model, intermediate_output)
+                output = output.detach().requires_grad_(True)
+                pipeline.forwarded(data_id, self.step_time["forward"][-1])
+                src.Metrics.IN_FLIGHT.set(len(data_store))
+
+                self.data_count += 1
+                self.send_intermediate_output(data_id, output, labels, trace, test,
+                                              received_data.get("window_end", False))
+        pbar.close()
+
+        validate = None
+        inference = None
+        if test_loader is not None:
+            labels, predictions, inference = self.infer(model, test_loader, pipeline.window)
+            validate = (labels, predictions)
 
         # Finish epoch training, send notify to server
+        notify_data = {"action": "NOTIFY", "client_id": self.client_id, "layer_id": self.layer_id,
+                       "message": "Finish training!", "validate": validate, "inference": inference}
         src.Log.print_with_color("[>>>] Finish training!", "red")
         self.send_to_server(notify_data)
 
-        broadcast_queue_name = f'reply_{self.client_id}'
         while True:  # Wait for broadcast
-            method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
-            if body:
-                received_data = pickle.loads(body)
-                src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
-                if received_data["action"] == "PAUSE":
-                    return True
-            time.sleep(0.5)
+            _, received_data = self.receive([broadcast_queue_name])
+            src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
+            if received_data["action"] == "PAUSE":
+                return True
 
-    def train_on_last_layer(self, model, lr, momentum):
+    def train_on_last_layer(self, model, lr, momentum, pipeline):
         optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
         result = True
 
         criterion = nn.CrossEntropyLoss()
         forward_queue_name = f'intermediate_queue_{self.layer_id - 1}'
-        self.channel.queue_declare(queue=forward_queue_name, durable=False)
-        self.channel.basic_qos(prefetch_count=10)
+        broadcast_queue_name = f'reply_{self.client_id}'
+        self.transport.declare(forward_queue_name)
+        self.transport.set_prefetch(10)
         print('Waiting for intermediate output. To exit press CTRL+C')
         model.to(self.device)
         while True:
             # Training model
             model.train()
-            optimizer.zero_grad()
-            # Process gradient
-            method_frame, header_frame, body = self.channel.basic_get(queue=forward_queue_name, auto_ack=True)
-            if method_frame and body:
-                received_data = pickle.loads(body)
-                intermediate_output_numpy = received_data["data"]
+            start = time.perf_counter_ns()
+            queue, received_data = self.receive([forward_queue_name, broadcast_queue_name])
+            if queue != broadcast_queue_name:
+                pipeline.wait(time.perf_counter_ns() - start)
+
+            if queue == forward_queue_name:
                 trace = received_data["trace"]
                 data_id = received_data["data_id"]
-                labels = received_data["label"].to(self.device)
+                labels = received_data["label"]
+
+                if received_data["test"]:
+                    # Held-out batch: send the predicted classes back to the first layer
+                    if pipeline.accumulated:
+                        self.optimizer_step(pipeline, optimizer)
+                    with torch.no_grad(), self.precision.autocast(), self.tracer.span("inference", data_id):
+                        predictions = self.inference_model(model)(received_data["data"]).argmax(1)
+                    self.send_validation(data_id, predictions.cpu(), trace)
+                    continue
 
-                intermediate_output = torch.tensor(intermediate_output_numpy, requires_grad=True).to(self.device)
+                intermediate_output = received_data["data"].requires_grad_(True)
 
-                if self.event_time:
-                    self.time_event.append(time.time())
-                output = model(intermediate_output)
-                loss = criterion(output, labels)
+                start = time.perf_counter_ns()
+                with self.tracer.span("forward", data_id), self.precision.autocast():
+                    output = model(intermediate_output)
+                    loss = criterion(output, labels)
+                self.step_time["forward"].append(time.perf_counter_ns() - start)
+                src.Metrics.STEP.observe(self.step_time["forward"][-1] / 1e9, phase="forward")
                 print(f"Loss: {loss.item()}")
+                src.Metrics.LOSS.set(loss.item())
                 if torch.isnan(loss).any():
                     src.Log.print_with_color("NaN detected in loss", "yellow")
                     result = False
 
                 intermediate_output.retain_grad()
-                loss.backward()
-                optimizer.step()
+                scale = self.precision.scale
+                start = time.perf_counter_ns()
+                with self.tracer.span("backward", data_id):
+                    finite = self.precision.backward(model, lambda: (loss * scale).backward(), scale)
+                self.precision.update(finite)
+                self.step_time["backward"].append(time.perf_counter_ns() - start)
+                src.Metrics.STEP.observe(self.step_time["backward"][-1] / 1e9, phase="backward")
+                if finite:
+                    pipeline.accumulated += 1
+                # With gpipe, gradients are accumulated until the last micro-batch of a first layer window
+                if pipeline.policy != "gpipe" or received_data.get("window_end", False):
+                    self.optimizer_step(pipeline, optimizer, data_id)
                 self.data_count += 1
 
                 gradient = intermediate_output.grad
-                if self.event_time:
-                    self.time_event.append(time.time())
-                self.send_gradient(data_id, gradient, trace)  # 1F1B
+                self.send_gradient(data_id, gradient, trace, scale)
             # Check training process
             else:
-                broadcast_queue_name = f'reply_{self.client_id}'
-                method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
-                if body:
-                    received_data = pickle.loads(body)
-                    src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
-                    if received_data["action"] == "PAUSE":
-                        return result
-
-    def train_on_middle_layer(self, model, lr, momentum, control_count=5):
-        optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
-
-        forward_queue_name = f'intermediate_queue_{self.layer_id - 1}'
-        backward_queue_name = f'gradient_queue_{self.layer_id}_{self.client_id}'
-        self.channel.queue_declare(queue=forward_queue_name, durable=False)
-        self.channel.queue_declare(queue=backward_queue_name, durable=False)
-        self.channel.basic_qos(prefetch_count=10)
-        data_store = {}
-        print('Waiting for intermediate output. To exit press CTRL+C')
-        model.to(self.device)
-        while True:
-            # Training model
-            model.train()
-            optimizer.zero_grad()
-            # Process gradient
-            method_frame, header_frame, body = self.channel.basic_get(queue=backward_queue_name, auto_ack=True)
-            if method_frame and body:
-                if self.event_time:
-                    self.time_event.append(time.time())
-                received_data = pickle.loads(body)
-                gradient_numpy = received_data["data"]
-                gradient = torch.tensor(gradient_numpy).to(self.device)
-                trace = received_data["trace"]
-                data_id = received_data["data_id"]
-
-                data_input = data_store.pop(data_id)
+                src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
+                if received_data["action"] == "PAUSE":
+                    if pipeline.accumulated:
+                        self.optimizer_step(pipeline, optimizer)
+                    return result
+
+    def optimizer_step(self, pipeline, optimizer, data_id=None):
+        with self.tracer.span("optimizer_step", data_id):
+            pipeline.step(optimizer)
+        # Held-out batches of other first layer clients may arrive while this layer still trains
+        self.eval_model = None
+
+    def inference_model(self, model):
+        # Built on the held-out batches that follow an optimizer step, from the parameters at that point
+        if self.eval_model is None:
+            self.eval_model = src.Model.fuse_stage(model) if self.fuse else model
+        self.eval_model.eval()
+        return self.eval_model
+
+    def forward(self, model, data_input):
+        """Forward pass of a micro-batch, returns the output and what `backward` needs later.
+
+        With recompute, only the input is kept and the forward is run again on backward. Otherwise the
+        graph is kept, built on clones of the weights: optimizer steps on the live parameters would
+        invalidate the graphs of micro-batches still in flight.
+        """
+        start = time.perf_counter_ns()
+        saved = {}
+
+        def pack(tensor):
+            saved[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+            return tensor
+
+        if self.recompute:
+            with self.precision.autocast():
                 output = model(data_input)
-                data_input.retain_grad()
-                output.backward(gradient=gradient, retain_graph=True)
-                optimizer.step()
-
-                gradient = data_input.grad
-                if self.event_time:
-                    self.time_event.append(time.time())
-                self.send_gradient(data_id, gradient, trace)
-            else:
-                method_frame, header_frame, body = self.channel.basic_get(queue=forward_queue_name, auto_ack=True)
-                if method_frame and body:
-                    if self.event_time:
-                        self.time_event.append(time.time())
-                    received_data = pickle.loads(body)
-                    intermediate_output_numpy = received_data["data"]
-                    trace = received_data["trace"]
-                    data_id = received_data["data_id"]
-                    test = received_data["test"]
-                    labels = received_data["label"].to(self.device)
-
-                    intermediate_output = torch.tensor(intermediate_output_numpy, requires_grad=True).to(self.device)
-                    data_store[data_id] = intermediate_output
-
-                    output = model(intermediate_output)
-                    output = output.detach().requires_grad_(True)
-
-                    self.data_count += 1
-                    if self.event_time:
-                        self.time_event.append(time.time())
-                    self.send_intermediate_output(data_id, output, labels, trace, test)
-                    # speed control
-                    if len(data_store) > control_count:
-                        continue
-            # Check training process
-            if method_frame is None:
-                broadcast_queue_name = f'reply_{self.client_id}'
-                method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
-                if body:
-                    received_data = pickle.loads(body)
-                    src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
-                    if received_data["action"] == "PAUSE":
-                        return True
-
-    def train_on_device(self, model, lr, momentum, num_layers, control_count, train_loader=None):
+            stored = data_input
+        else:
+            weights = {name: param.clone() for name, param in model.named_parameters()}
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor), self.precision.autocast():
+                output = torch.func.functional_call(model, weights, (data_input,))
+            stored = (data_input, output)
+
+        self.step_time["forward"].append(time.perf_counter_ns() - start)
+        src.Metrics.STEP.observe(self.step_time["forward"][-1] / 1e9, phase="forward")
+        # Memory held until backward: the input plus the tensors saved by the graph
+        nbytes = sum(saved.values()) + data_input.nelement() * data_input.element_size()
+        self.held_bytes += nbytes
+        src.Metrics.HELD_BYTES.set(self.held_bytes)
+        self.peak_held_bytes = max(self.peak_held_bytes, self.held_bytes)
+        return output, (stored, nbytes)
+
+    def backward(self, model, stored, gradient, scale=1.0):
+        """Backward pass of a micro-batch from what `forward` stored, returns the gradient of its input.
+
+        `gradient` comes from a loss multiplied by `scale`, and so does the returned gradient. Also returns
+        False when the parameter gradients of the micro-batch overflowed and were dropped.
+        """
+        start = time.perf_counter_ns()
+        stored, nbytes = stored
+        if self.recompute:
+            data_input = stored
+            with self.precision.autocast():
+                output = model(data_input)
+        else:
+            data_input, output = stored
+        # The gradient arrives in the dtype it was sent in
+        gradient = gradient.to(output.dtype)
+        finite = self.precision.backward(model, lambda: output.backward(gradient=gradient,
+                                                                        retain_graph=self.recompute), scale)
+
+        self.step_time["backward"].append(time.perf_counter_ns() - start)
+        src.Metrics.STEP.observe(self.step_time["backward"][-1] / 1e9, phase="backward")
+        self.held_bytes -= nbytes
+        src.Metrics.HELD_BYTES.set(self.held_bytes)
+        return data_input.grad, finite
+
+    def step_report(self):
+        report = {"mode": "recompute" if self.recompute else "keep graph", "steps": len(self.step_time["backward"]),
+                  "forward_time": sum(self.step_time["forward"]) / max(len(self.step_time["forward"]), 1),
+                  "backward_time": sum(self.step_time["backward"]) / max(len(self.step_time["backward"]), 1),
+                  "peak_memory": self.peak_held_bytes, "precision": self.precision.report()}
+        if str(self.device).startswith("cuda"):
+            report["peak_memory"] = torch.cuda.max_memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.step_time = {"forward": [], "backward": []}
+        self.held_bytes = 0
+        self.peak_held_bytes = 0
+        return report
+
+    def set_compression(self, compression):
+        topk_ratio = compression.get("topk-ratio", 0.01) if compression else 0.01
+        # Activations go out on cut layer_id - 1, gradients on cut layer_id - 2 (0-based)
+        forward_mode = link_mode(compression, "activation", self.layer_id - 1)
+        backward_mode = link_mode(compression, "gradient", self.layer_id - 2)
+        # Every message carries other samples, what top-k drops from one must not be added to the next
+        if forward_mode != self.forward_compressor.mode:
+            self.forward_compressor = Compressor(forward_mode, topk_ratio, error_feedback=False)
+        if backward_mode != self.backward_compressor.mode:
+            self.backward_compressor = Compressor(backward_mode, topk_ratio, error_feedback=False)
+
+    def train_on_device(self, model, lr, momentum, num_layers, control_count, train_loader=None, compression=None,
+                        recompute=False, pipeline=None, test_loader=None, inference=None, precision=None):
         self.data_count = 0
-        if self.layer_id == 1:
-            result = self.train_on_first_layer(model, lr, momentum, control_count, train_loader)
-        elif self.layer_id == num_layers:
-            result = self.train_on_last_layer(model, lr, momentum)
+        # The loss scale of fp16 is kept from one round to the next
+        if (precision or "fp32") != self.precision.precision:
+            self.precision = Precision(precision or "fp32", self.device)
+        self.fuse = (inference or {}).get("fuse", False)
+        self.eval_model = None
+        self.recompute = recompute
+        self.set_compression(compression)
+        options = pipeline or {}
+        max_window = options.get("max-window", 16)
+        window = options.get("window")
+        if isinstance(window, list):
+            window = window[self.layer_id - 1] if self.layer_id - 1 < len(window) else None
+        if window is None:
+            # As before, the first layer may start a forward while at most control_count micro-batches are in flight
+            window = control_count + 1 if self.layer_id == 1 else max_window
+        pipeline = Pipeline(options.get("policy", "1f1b"), window, max_window)
+        if self.layer_id == num_layers:
+            result = self.train_on_last_layer(model, lr, momentum, pipeline)
         else:
-            result = self.train_on_middle_layer(model, lr, momentum, control_count)
-        if self.event_time:
-            src.Log.print_with_color(f"Training time events {self.time_event}", "yellow")
-        return result, self.data_count
+            result = self.train_on_stage(model, lr, momentum, pipeline, train_loader, test_loader)
+        # Hand the queues back, RpcClient reads the reply queue between rounds
+        self.transport.cancel()
+
+        stats = {"compression": {"activation": self.forward_compressor.report(),
+                                 "gradient": self.backward_compressor.report()},
+                 "step": self.step_report(),
+                 "pipeline": pipeline.report()}
+        if self.tracer.enabled:
+            stats["trace"] = self.tracer.drain()
+        return result, self.data_count, stats
@@ -0,0 +1,98 @@
+import pickle
+import struct
+import warnings
+from collections import OrderedDict
+
+import torch
+
+# Frame layout: MAGIC | header length | pickled header | tensor buffers, each aligned to ALIGNMENT bytes.
+# The header holds every non-tensor field (data_id, trace, ...) and the dtype, shape and offset of each tensor.
+MAGIC = b"SLT1"
+ALIGNMENT = 64
+PREFIX = struct.Struct("<4sI")
+
+
+class TensorRef:
+    def __init__(self, index):
+        self.index = index
+
+
+def align(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def strip_tensors(obj, tensors):
+    if isinstance(obj, torch.Tensor):
+        tensors.append(obj)
+        return TensorRef(len(tensors) - 1)
+    if isinstance(obj, dict):
+        stripped = type(obj)((key, strip_tensors(value, tensors)) for key, value in obj.items())
+        if isinstance(obj, OrderedDict) and hasattr(obj, "_metadata"):
+            # state_dict version info, used by load_state_dict
+            stripped._metadata = obj._metadata
+        return stripped
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(strip_tensors(value, tensors) for value in obj)
+    return obj
+
+
+def fill_tensors(obj, tensors):
+    if isinstance(obj, TensorRef):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        filled = type(obj)((key, fill_tensors(value, tensors)) for key, value in obj.items())
+        if isinstance(obj, OrderedDict) and hasattr(obj, "_metadata"):
+            filled._metadata = obj._metadata
+        return filled
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(fill_tensors(value, tensors) for value in obj)
+    return obj
+
+
+def dumps(message, mode="binary"):
+    if mode == "pickle":
+        return pickle.dumps(message)
+    if mode != "binary":
+        raise ValueError(f"Serialization '{mode}' is not supported.")
+
+    tensors = []
+    skeleton = strip_tensors(message, tensors)
+
+    specs = []
+    buffers = []
+    offset = 0
+    for tensor in tensors:
+        tensor = tensor.detach().cpu().contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        specs.append((tensor.dtype, tuple(tensor.shape), offset, nbytes))
+        if nbytes:
+            # Raw bytes view of the tensor, copied only once by the final join
+            buffers.append(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+            buffers.append(bytes(align(nbytes) - nbytes))
+        offset += align(nbytes)
+
+    header = pickle.dumps((skeleton, specs), protocol=pickle.HIGHEST_PROTOCOL)
+    padding = bytes(align(PREFIX.size + len(header)) - PREFIX.size - len(header))
+    return b"".join([PREFIX.pack(MAGIC, len(header)), header, padding] + buffers)
+
+
+def loads(body):
+    if body[:len(MAGIC)] != MAGIC:
+        return pickle.loads(body)
+
+    _, header_size = PREFIX.unpack_from(body)
+    skeleton, specs = pickle.loads(memoryview(body)[PREFIX.size:PREFIX.size + header_size])
+    start = align(PREFIX.size + header_size)
+
+    tensors = []
+    for dtype, shape, offset, nbytes in specs:
+        if nbytes == 0:
+            tensors.append(torch.empty(shape, dtype=dtype))
+            continue
+        count = nbytes // torch.empty((), dtype=dtype).element_size()
+        with warnings.catch_warnings():
+            # Decoded tensors share memory with the received (read-only) bytes, they are never written in place
+            warnings.filterwarnings("ignore", message="The given buffer is not writable")
+            tensor = torch.frombuffer(body, dtype=dtype, count=count, offset=start + offset)
+        tensors.append(tensor.view(shape))
+    return fill_tensors(skeleton, tensors)
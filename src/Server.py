@@ -1,143 +1,169 @@
 import os
 import time
-import pika
-import pickle
 import sys
+import multiprocessing
 import yaml
 import numpy as np
 import torch
-import torch.nn as nn
-import requests
 
-from requests.auth import HTTPBasicAuth
-
-import src.Model
 import src.Log
+import src.Metrics
+import src.Model
+import src.Partitioner
+import src.Profiler
 import src.Utils
 import src.Validation
+from concurrent.futures import ProcessPoolExecutor
 
-num_labels = 10
-
-
-def delete_old_queues(address, username, password):
-    url = f'http://{address}:15672/api/queues'
-    response = requests.get(url, auth=HTTPBasicAuth(username, password))
-
-    if response.status_code == 200:
-        queues = response.json()
-
-        credentials = pika.PlainCredentials(username, password)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(address, 5672, '/', credentials))
-        http_channel = connection.channel()
+from src.Aggregation import StreamingAverage
+from src.Compression import Compressor, apply_delta, state_dict_delta
+from src.Trace import save_chrome_trace
+from src.Transport import create_transport
 
-        for queue in queues:
-            queue_name = queue['name']
-            if queue_name.startswith("reply") or queue_name.startswith("intermediate_queue") or queue_name.startswith(
-                    "gradient_queue") or queue_name.startswith("rpc_queue"):
-                try:
-                    http_channel.queue_delete(queue=queue_name)
-                    src.Log.print_with_color(f"Queue '{queue_name}' deleted.", "green")
-                except Exception as e:
-                    src.Log.print_with_color(f"Failed to delete queue '{queue_name}': {e}", "yellow")
-            else:
-                try:
-                    http_channel.queue_purge(queue=queue_name)
-                    src.Log.print_with_color(f"Queue '{queue_name}' purged.", "green")
-                except Exception as e:
-                    src.Log.print_with_color(f"Failed to purge queue '{queue_name}': {e}", "yellow")
-
-        connection.close()
-        return True
-    else:
-        src.Log.print_with_color(
-            f"Failed to fetch queues from RabbitMQ Management API. Status code: {response.status_code}", "yellow")
+num_labels = 10
+worker_logger = None
+
+
+def validate_round(model_name, state_dict_full, log_path, filepath, options=None, full=True):
+    # Runs in the validation worker: test the averaged model and save it only if it passed
+    global worker_logger
+    if worker_logger is None:
+        worker_logger = src.Log.Logger(f"{log_path}/app.log")
+    options = options or {}
+    if not src.Validation.test(model_name, state_dict_full, worker_logger,
+                               subsample=0 if full else options.get("subsample", 0),
+                               batch_size=options.get("batch-size", 1000), threads=options.get("threads", 0),
+                               fuse=options.get("fuse", False)):
         return False
+    torch.save(state_dict_full, filepath)
+    return True
 
 
 class Server:
-    def __init__(self, config_dir):
+    def __init__(self, config_dir, broker=None):
         with open(config_dir, 'r') as file:
             config = yaml.safe_load(file)
 
-        address = config["rabbit"]["address"]
-        username = config["rabbit"]["username"]
-        password = config["rabbit"]["password"]
-        delete_old_queues(address, username, password)
+        self.config = config
+        self.broker = broker
+        self.transport = create_transport(config, broker)
+        self.transport.clear_queues()
 
         self.model_name = config["server"]["model"]
         self.total_clients = config["server"]["clients"]
         self.cut_layers = config["server"]["cut_layers"]
+        self.partition = config["server"].get("partition") or {}
         self.num_round = config["server"]["num-round"]
         self.round = self.num_round
         self.save_parameters = config["server"]["parameters"]["save"]
         self.load_parameters = config["server"]["parameters"]["load"]
         self.validation = config["server"]["validation"]
+        self.validation_options = config["server"].get("validation-options") or {}
+        inference = config["server"].get("inference") or {}
+        self.inference = inference if inference.get("enable") else None
+        self.speculative_round = config["server"].get("speculative-round", False)
 
         # Clients
         self.batch_size = config["learning"]["batch-size"]
         self.lr = config["learning"]["learning-rate"]
         self.momentum = config["learning"]["momentum"]
         self.control_count = config["learning"]["control-count"]
+        self.compression = config["learning"].get("compression")
+        self.recompute = config["learning"].get("recompute", False)
+        self.data_pipeline = config["learning"].get("data-pipeline", "torchvision")
+        self.data_loader = config["learning"].get("data-loader")
+        self.parameter_delta = config["learning"].get("parameter-delta") or {}
+        self.pipeline = config["learning"].get("pipeline")
+        self.compile = config["learning"].get("compile")
+        self.precision = config["learning"].get("precision", "fp32")
+        self.compute = config["learning"].get("compute")
 
         log_path = config["log_path"]
+        self.log_path = log_path
         self.label_count = [5000 // self.total_clients[0] for _ in range(num_labels)]
         self.time_start = None
         self.time_stop = None
 
-        credentials = pika.PlainCredentials(username, password)
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(address, 5672, '/', credentials))
-        self.channel = self.connection.channel()
-
-        self.channel.queue_declare(queue='rpc_queue')
+        self.transport.declare('rpc_queue')
 
         self.current_clients = [0 for _ in range(len(self.total_clients))]
         self.register_clients = [0 for _ in range(len(self.total_clients))]
         self.first_layer_clients = 0
-        self.responses = {}  # Save response
         self.list_clients = []
+        self.profiles = [[] for _ in range(len(self.total_clients))]
+        # (client_id, compute time of a micro-batch) of each layer, from the last UPDATE messages
+        self.stage_timings = [[] for _ in range(len(self.total_clients))]
+        self.template_profile = None
+        # (client_id, layer_id, spans) of the round in progress, clients started with --event_time
+        self.traces = []
         self.avg_state_dict = [[] for _ in range(len(self.total_clients))]
         self.round_result = True
-
-        self.all_model_parameters = [[] for _ in range(len(self.total_clients))]
-        self.all_client_sizes = [[] for _ in range(len(self.total_clients))]
+        self.partition_cache = None
+
+        # Parameters each layer's clients hold since the last START, and the version each client reported
+        self.parameter_version = 0
+        self.parameter_views = {}
+        self.client_versions = {}
+
+        # Validation runs in a worker process while the consumer keeps serving messages
+        self.validator = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        self.validating = False
+        self.speculative = False
+        self.round_waiting = False
+        self.discard_round = False
+        # Full state_dict of the last parameters that passed validation (or the initial ones), and the one
+        # being validated: a rejected round is trained again from the accepted parameters
+        self.accepted_state_dict = None
+        self.validated_state_dict = None
+
+        self.aggregators = [StreamingAverage() for _ in range(len(self.total_clients))]
         self.all_labels = np.array([])
         self.all_vals = np.array([])
 
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(queue='rpc_queue', on_message_callback=self.on_request)
+        self.transport.set_prefetch(1)
+        self.transport.consume('rpc_queue', self.on_request)
+        src.Metrics.start_server(config)
         self.logger = src.Log.Logger(f"{log_path}/app.log")
         self.logger.log_info("Application start")
 
         src.Log.print_with_color(f"Server is waiting for {self.total_clients} clients.", "green")
 
-    def on_request(self, ch, method, props, body):
-        message = pickle.loads(body)
-        routing_key = props.reply_to
+    def on_request(self, message):
         action = message["action"]
         client_id = message["client_id"]
         layer_id = message["layer_id"]
-        self.responses[routing_key] = message
+        if action == "VALIDATED":
+            self.on_validated(message["result"])
+            return
         if (str(client_id), layer_id) not in self.list_clients:
             self.list_clients.append((str(client_id), layer_id))
 
         if action == "REGISTER":
-            src.Log.print_with_color(f"[<<<] Received message from client: {message}", "blue")
+            registration = {key: value for key, value in message.items() if key != "profile"}
+            src.Log.print_with_color(f"[<<<] Received message from client: {registration}", "blue")
             # Save messages from clients
             self.register_clients[layer_id - 1] += 1
+            if message.get("profile"):
+                self.profiles[layer_id - 1].append((str(client_id), message["profile"], message.get("bandwidth")))
 
             # If consumed all clients - Register for first time
             if self.register_clients == self.total_clients:
                 src.Log.print_with_color("All clients are connected. Sending notifications.", "green")
+                if self.partition.get("auto"):
+                    self.auto_partition()
                 src.Log.print_with_color(f"Start training round {self.num_round - self.round + 1}", "yellow")
-                self.notify_clients()
+                self.notify_clients(state_dict_full=self.initial_parameters())
         elif action == "NOTIFY":
-            src.Log.print_with_color(f"[<<<] Received message from client: {message}", "blue")
+            notification = {key: value for key, value in message.items() if key not in ("validate", "inference")}
+            src.Log.print_with_color(f"[<<<] Received message from client: {notification}", "blue")
             if layer_id == 1:
                 self.first_layer_clients += 1
                 validate = message["validate"]
                 if validate:
                     self.all_labels = np.append(self.all_labels, validate[0])
                     self.all_vals = np.append(self.all_vals, validate[1])
+                if message.get("inference"):
+                    self.report_inference(client_id, message["inference"])
 
             if self.first_layer_clients == self.total_clients[0]:
                 self.first_layer_clients = 0
@@ -161,7 +187,7 @@ class Server:
                     message = {"action": "PAUSE",
                                "message": "Pause training and please send your parameters",
                                "parameters": None}
-                    self.send_to_response(client_id, pickle.dumps(message))
+                    self.send_to_response(client_id, message)
         elif action == "UPDATE":
             data_message = message["message"]
             result = message["result"]
@@ -169,137 +195,408 @@ class Server:
             self.current_clients[layer_id - 1] += 1
             if not result:
                 self.round_result = False
+            self.client_versions[str(client_id)] = message.get("version")
+            if message.get("stats"):
+                self.report_compression(layer_id, message["stats"]["compression"])
+                step = message["stats"]["step"]
+                self.report_step(layer_id, step)
+                if step["steps"]:
+                    self.stage_timings[layer_id - 1].append((str(client_id),
+                                                             step["forward_time"] + step["backward_time"]))
+                if message["stats"].get("pipeline"):
+                    self.report_pipeline(layer_id, message["stats"]["pipeline"])
+                if message["stats"].get("trace"):
+                    self.traces.append((str(client_id), layer_id, message["stats"]["trace"]))
 
             # Save client's model parameters
             if self.save_parameters and self.round_result:
                 model_state_dict = message["parameters"]
+                if message.get("delta") is not None:
+                    model_state_dict = self.restore_parameters(layer_id, message["version"], message["delta"])
                 client_size = message["size"]
-                self.all_model_parameters[layer_id - 1].append(model_state_dict)
-                self.all_client_sizes[layer_id - 1].append(client_size)
+                if model_state_dict is not None:
+                    self.aggregators[layer_id - 1].add(model_state_dict, client_size)
 
             # If consumed all client's parameters
             if self.current_clients == self.total_clients:
                 src.Log.print_with_color("Collected all parameters.", "yellow")
-                if self.save_parameters and self.round_result:
-                    self.avg_all_parameters()
-                    self.all_model_parameters = [[] for _ in range(len(self.total_clients))]
-                    self.all_client_sizes = [[] for _ in range(len(self.total_clients))]
                 self.current_clients = [0 for _ in range(len(self.total_clients))]
-                # Test
-                if self.save_parameters and self.validation and self.round_result:
-                    state_dict_full = self.concatenate_state_dict()
-                    if not src.Validation.test(self.model_name, state_dict_full, self.logger):
-                        src.Log.print_with_color("Training failed!", "yellow")
-                    else:
-                        # Save to files
-                        torch.save(state_dict_full, f'{self.model_name}.pth')
-                        self.round -= 1
+                src.Metrics.ROUND.observe((time.time_ns() - self.time_start) / 1e9)
+                if self.traces:
+                    self.save_trace()
+                if self.discard_round:
+                    # Trained on top of parameters that failed validation
+                    src.Log.print_with_color("Discarded round started from rejected parameters.", "yellow")
+                    self.aggregators = [StreamingAverage() for _ in range(len(self.total_clients))]
+                    self.discard_round = False
+                    self.speculative = False
+                    self.next_round(self.accepted_state_dict)
+                elif self.validating:
+                    self.round_waiting = True
                 else:
-                    self.round -= 1
-
-                # Start a new training round
-                self.round_result = True
-
-                if self.round > 0:
-                    src.Log.print_with_color(f"Start training round {self.num_round - self.round + 1}", "yellow")
-                    if self.save_parameters:
-                        self.notify_clients()
-                    else:
-                        self.notify_clients(register=False)
-                else:
-                    self.notify_clients(start=False)
-                    sys.exit()
-
-        # Ack the message
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+                    self.end_round()
+
+    def end_round(self):
+        if self.save_parameters and self.round_result:
+            self.avg_all_parameters()
+        self.aggregators = [StreamingAverage() for _ in range(len(self.total_clients))]
+        # Test
+        if self.save_parameters and self.validation and self.round_result:
+            state_dict_full = self.concatenate_state_dict()
+            # The last round, and every full-every rounds, are checked on the whole test set
+            full = self.round == 1 or self.round_number() % self.validation_options.get("full-every", 1) == 0
+            future = self.validator.submit(validate_round, self.model_name, state_dict_full, self.log_path,
+                                           f'{self.model_name}.pth', self.validation_options, full)
+            future.add_done_callback(self.post_validation)
+            self.validating = True
+            self.validated_state_dict = state_dict_full
+            self.round_result = True
+            if self.speculative_round and self.round > 1:
+                # Start the next round on the new parameters, before knowing whether they pass
+                self.speculative = True
+                src.Log.print_with_color(f"Start training round {self.round_number()}", "yellow")
+                self.notify_clients(state_dict_full=state_dict_full)
+        else:
+            self.round -= 1
+            self.next_round()
+
+    def next_round(self, state_dict_full=None):
+        # Start a new training round, from `state_dict_full` when given
+        self.round_result = True
 
-    def notify_clients(self, start=True, register=True):
-        # Send message to clients when consumed all clients
-        klass = getattr(src.Model, self.model_name)
-        full_model = klass()
-        full_model = nn.Sequential(*nn.ModuleList(full_model.children()))
+        if self.round > 0:
+            src.Log.print_with_color(f"Start training round {self.round_number()}", "yellow")
+            if self.save_parameters:
+                self.notify_clients(state_dict_full=state_dict_full)
+            else:
+                self.notify_clients(register=False, state_dict_full=state_dict_full)
+        else:
+            self.notify_clients(start=False)
+            self.validator.shutdown()
+            sys.exit()
+
+    def post_validation(self, future):
+        # Called on a worker thread of the pool, hand the result over to the consumer through rpc_queue
+        try:
+            result = future.result()
+        except Exception as e:
+            src.Log.print_with_color(f"Validation failed with error: {e}", "yellow")
+            result = False
+        transport = create_transport(self.config, self.broker)
+        transport.publish('rpc_queue', {"action": "VALIDATED", "client_id": None, "layer_id": None,
+                                        "result": result})
+        transport.close()
+
+    def on_validated(self, result):
+        self.validating = False
+        if result:
+            self.accepted_state_dict = self.validated_state_dict
+            self.round -= 1
+            if not self.speculative:
+                self.next_round()
+                return
+            self.speculative = False
+            if self.round_waiting:
+                self.round_waiting = False
+                self.end_round()
+        else:
+            src.Log.print_with_color("Training failed!", "yellow")
+            if not self.speculative:
+                self.next_round(self.accepted_state_dict)
+            elif self.round_waiting:
+                src.Log.print_with_color("Discarded round started from rejected parameters.", "yellow")
+                self.aggregators = [StreamingAverage() for _ in range(len(self.total_clients))]
+                self.round_waiting = False
+                self.speculative = False
+                self.next_round(self.accepted_state_dict)
+            else:
+                # Let the round in flight finish, then train it again from the last accepted parameters
+                self.discard_round = True
+
+    def save_trace(self):
+        path = f"{self.log_path}/trace_round_{self.round_number()}.json"
+        save_chrome_trace(self.traces, path)
+        src.Log.print_with_color(f"Saved trace of {sum(len(events) for _, _, events in self.traces)} spans to {path}",
+                                 "yellow")
+        self.traces = []
+
+    def round_number(self):
+        # A speculative round starts before the previous one is counted
+        return self.num_round - self.round + 1 + int(self.speculative)
+
+    def initial_parameters(self):
+        """Full state_dict of the first round when speculative rounds may have to roll back, else None.
+
+        The parameters file when it is loaded, otherwise a new model. Clients then all start from parameters
+        the server knows.
+        """
+        if not (self.speculative_round and self.save_parameters and self.validation):
+            return None
+        filepath = f'{self.model_name}.pth'
+        if self.load_parameters and os.path.exists(filepath):
+            self.accepted_state_dict = torch.load(filepath, weights_only=True)
+        else:
+            self.accepted_state_dict = src.Model.build_stage(self.model_name).state_dict()
+        return self.accepted_state_dict
+
+    def notify_clients(self, start=True, register=True, state_dict_full=None):
+        # Send message to clients when consumed all clients, parameters given in `state_dict_full` are always sent
+        parameters = {}
+        if start and (state_dict_full is not None or (self.load_parameters and register)):
+            if state_dict_full is not None or os.path.exists(f'{self.model_name}.pth'):
+                # Cut layers only move when the clients get the parameters of their new layers
+                self.rebalance()
+            parameters = self.partition_parameters(state_dict_full)
+        if parameters:
+            self.parameter_version += 1
+
+        # Every client of a layer gets the same message, encoded once
+        responses = {}
         for (client_id, layer_id) in self.list_clients:
-            # Read parameters file
-            filepath = f'{self.model_name}.pth'
-            state_dict = None
-
             if start:
-                if layer_id == 1:
-                    layers = [0, self.cut_layers[0]]
-                elif layer_id == len(self.total_clients):
-                    layers = [self.cut_layers[-1], -1]
-                else:
-                    layers = [self.cut_layers[layer_id - 2], self.cut_layers[layer_id - 1]]
-
-                if self.load_parameters and register:
-                    if os.path.exists(filepath):
-                        full_state_dict = torch.load(filepath, weights_only=True)
-                        full_model.load_state_dict(full_state_dict)
-
-                        if layer_id == 1:
-                            model_part = nn.Sequential(*nn.ModuleList(full_model.children())[:layers[1]])
-                        elif layer_id == len(self.total_clients):
-                            model_part = nn.Sequential(*nn.ModuleList(full_model.children())[layers[0]:])
-                        else:
-                            model_part = nn.Sequential(*nn.ModuleList(full_model.children())[layers[0]:layers[1]])
-
-                        state_dict = model_part.state_dict()
-                        src.Log.print_with_color("Model loaded successfully.", "green")
-                    else:
-                        src.Log.print_with_color(f"File {filepath} does not exist.", "yellow")
-
+                if layer_id not in responses:
+                    response = {"action": "START",
+                                "message": "Server accept the connection!",
+                                "parameters": None,
+                                "num_layers": len(self.total_clients),
+                                "layers": self.layer_range(layer_id),
+                                "model_name": self.model_name,
+                                "control_count": self.control_count,
+                                "batch_size": self.batch_size,
+                                "lr": self.lr,
+                                "momentum": self.momentum,
+                                "compression": self.compression,
+                                "recompute": self.recompute,
+                                "data_pipeline": self.data_pipeline,
+                                "data_loader": self.data_loader,
+                                "parameter_delta": self.parameter_delta,
+                                "pipeline": self.pipeline,
+                                "inference": self.inference,
+                                "compile": self.compile,
+                                "precision": self.precision,
+                                "compute": self.compute,
+                                "label_count": self.label_count}
+                    if layer_id in parameters:
+                        response.update(self.layer_parameters(layer_id, parameters[layer_id]))
+                    responses[layer_id] = self.transport.prepare(response)
                 src.Log.print_with_color(f"[>>>] Sent start training request to client {client_id}", "red")
-                response = {"action": "START",
-                            "message": "Server accept the connection!",
-                            "parameters": state_dict,
-                            "num_layers": len(self.total_clients),
-                            "layers": layers,
-                            "model_name": self.model_name,
-                            "control_count": self.control_count,
-                            "batch_size": self.batch_size,
-                            "lr": self.lr,
-                            "momentum": self.momentum,
-                            "label_count": self.label_count}
             else:
+                if layer_id not in responses:
+                    response = {"action": "STOP",
+                                "message": "Stop training!",
+                                "parameters": None}
+                    responses[layer_id] = self.transport.prepare(response)
                 src.Log.print_with_color(f"[>>>] Sent stop training request to client {client_id}", "red")
-                response = {"action": "STOP",
-                            "message": "Stop training!",
-                            "parameters": None}
             self.time_start = time.time_ns()
-            self.send_to_response(client_id, pickle.dumps(response))
+            self.send_to_response(client_id, responses[layer_id])
+
+    def auto_partition(self):
+        if [len(profiles) for profiles in self.profiles] != self.total_clients:
+            src.Log.print_with_color(f"Not every client sent a profile, keeping cut layers {self.cut_layers}.",
+                                     "yellow")
+            return
+        stage_profiles = [[profile for _, profile, _ in profiles] for profiles in self.profiles]
+        bandwidths = [[bandwidth for _, _, bandwidth in profiles] for profiles in self.profiles]
+        cut_layers, time_max = src.Partitioner.partition(stage_profiles, stage_profiles[0][0]["output_bytes"],
+                                                         bandwidths, self.partition.get("bandwidth"))
+
+        text = f"Partition at: {cut_layers}, slowest layer {time_max / 1e9:.4f} s per micro-batch"
+        src.Log.print_with_color(text, "green")
+        self.logger.log_info(text)
+        self.set_cut_layers(cut_layers)
+
+    def rebalance(self):
+        """Move the cut layers when the compute time measured on each layer is too uneven."""
+        threshold = self.partition.get("rebalance")
+        timings = self.stage_timings
+        self.stage_timings = [[] for _ in range(len(self.total_clients))]
+        if not threshold or any(len(stage) == 0 for stage in timings):
+            return
+
+        # Clients of a layer share its micro-batches
+        stage_times = [1 / sum(1 / max(measured, 1) for _, measured in stage) for stage in timings]
+        imbalance = max(stage_times) / (sum(stage_times) / len(stage_times)) - 1
+        text = (f"Layer times {[round(t / 1e6, 2) for t in stage_times]} ms per micro-batch, "
+                f"imbalance {100 * imbalance:.1f}%")
+        src.Log.print_with_color(text, "yellow")
+        self.logger.log_info(text)
+        if imbalance <= threshold:
+            return
+
+        # Per-layer times of each client: its profile (or one taken here) scaled to what it measured
+        profiles = {client_id: (profile, bandwidth)
+                    for stage in self.profiles for client_id, profile, bandwidth in stage}
+        stage_profiles = []
+        bandwidths = []
+        for layer_id, stage in enumerate(timings, start=1):
+            start, end = self.layer_range(layer_id)
+            end = None if end == -1 else end
+            stage_profiles.append([])
+            bandwidths.append([])
+            for client_id, measured in stage:
+                profile, bandwidth = profiles.get(client_id, (None, None))
+                if profile is None:
+                    if self.template_profile is None:
+                        self.template_profile = src.Profiler.profile_model(self.model_name, self.batch_size,
+                                                                           rounds=3, warmup=1)
+                    profile = self.template_profile
+                layers = len(profile["output_bytes"])
+                stage_profiles[-1].append(src.Partitioner.fit_profile(profile, start, end or layers, measured))
+                bandwidths[-1].append(bandwidth)
+
+        output_bytes = stage_profiles[0][0]["output_bytes"]
+        cut_layers, time_max = src.Partitioner.partition(stage_profiles, output_bytes, bandwidths,
+                                                         self.partition.get("bandwidth"))
+        # Measurements are noisy, only move for a clear gain
+        stage_time = src.Partitioner.stage_timer(stage_profiles, output_bytes, bandwidths,
+                                                 self.partition.get("bandwidth"))
+        current = 0
+        for layer_id in range(1, len(timings) + 1):
+            start, end = self.layer_range(layer_id)
+            current = max(current, stage_time(layer_id - 1, start, len(output_bytes) if end == -1 else end))
+        if cut_layers != self.cut_layers and time_max < (1 - threshold) * current:
+            text = (f"Re-partition from {self.cut_layers} to {cut_layers}, "
+                    f"slowest layer {time_max / 1e9:.4f} s per micro-batch")
+            src.Log.print_with_color(text, "green")
+            self.logger.log_info(text)
+            self.set_cut_layers(cut_layers)
+
+    def set_cut_layers(self, cut_layers):
+        if cut_layers == self.cut_layers:
+            return
+        self.cut_layers = cut_layers
+        # Parameters held by the clients no longer match their layers
+        self.parameter_views = {}
+        self.partition_cache = None
+
+    def layer_range(self, layer_id):
+        if layer_id == 1:
+            return [0, self.cut_layers[0]]
+        elif layer_id == len(self.total_clients):
+            return [self.cut_layers[-1], -1]
+        else:
+            return [self.cut_layers[layer_id - 2], self.cut_layers[layer_id - 1]]
+
+    def layer_parameters(self, layer_id, state_dict):
+        # Send a delta when all clients of the layer hold the last parameters sent to it, otherwise a full snapshot
+        mode = self.parameter_delta.get("mode", "none")
+        if mode == "none":
+            return {"parameters": state_dict}
+
+        version = self.parameter_version
+        view = self.parameter_views.get(layer_id)
+        clients = [client_id for (client_id, client_layer_id) in self.list_clients if client_layer_id == layer_id]
+        if view is None or any(self.client_versions.get(client_id) != view[0] for client_id in clients):
+            self.parameter_views[layer_id] = (version, state_dict)
+            return {"parameters": state_dict, "version": version}
+
+        # The delta is taken against what clients rebuild, so quantization error is not accumulated
+        compressor = Compressor(mode, self.parameter_delta.get("topk-ratio", 0.01), error_feedback=False)
+        delta = state_dict_delta(compressor, state_dict, view[1])
+        self.parameter_views[layer_id] = (version, apply_delta(view[1], delta))
+
+        report = compressor.report()
+        text = (f"Round {self.round_number()}, layer {layer_id} parameters: {mode} delta against version {view[0]}, "
+                f"ratio {report['ratio']:.2f}x")
+        src.Log.print_with_color(text, "yellow")
+        self.logger.log_info(text)
+        return {"delta": delta, "base_version": view[0], "version": version}
+
+    def restore_parameters(self, layer_id, version, delta):
+        view = self.parameter_views.get(layer_id)
+        if view is None or view[0] != version:
+            src.Log.print_with_color(f"Received a delta against unknown parameters version {version}.", "yellow")
+            self.round_result = False
+            return None
+        return apply_delta(view[1], delta)
+
+    def partition_parameters(self, state_dict_full=None):
+        """state_dict of each layer's model part, taken from `state_dict_full` or the parameters file.
+
+        Slices share tensors with the full state_dict. Those of the file are kept until it changes.
+        """
+        if state_dict_full is None:
+            filepath = f'{self.model_name}.pth'
+            if not os.path.exists(filepath):
+                src.Log.print_with_color(f"File {filepath} does not exist.", "yellow")
+                return {}
+            stat = os.stat(filepath)
+            version = (stat.st_mtime_ns, stat.st_size)
+            if self.partition_cache is not None and self.partition_cache[0] == version:
+                return self.partition_cache[1]
+            state_dict_full = torch.load(filepath, weights_only=True)
+        else:
+            version = None
+
+        parameters = {}
+        for layer_id in range(1, len(self.total_clients) + 1):
+            start, end = self.layer_range(layer_id)
+            parameters[layer_id] = src.Utils.slice_state_dict(state_dict_full, start, None if end == -1 else end)
+        src.Log.print_with_color("Model loaded successfully.", "green")
+
+        if version is not None:
+            self.partition_cache = (version, parameters)
+        return parameters
 
     def start(self):
-        self.channel.start_consuming()
+        self.transport.start_consuming()
 
     def send_to_response(self, client_id, message):
-        reply_channel = self.connection.channel()
         reply_queue_name = f'reply_{client_id}'
-        reply_channel.queue_declare(reply_queue_name, durable=False)
+        self.transport.declare(reply_queue_name)
 
         src.Log.print_with_color(f"[>>>] Sent notification to client {client_id}", "red")
-        reply_channel.basic_publish(
-            exchange='',
-            routing_key=reply_queue_name,
-            body=message
-        )
+        self.transport.publish(reply_queue_name, message)
+
+    def report_compression(self, layer_id, compression):
+        for kind, report in compression.items():
+            if report["mode"] == "none" or report["messages"] == 0:
+                continue
+            text = (f"Round {self.round_number()}, layer {layer_id} {kind} compression {report['mode']}: "
+                    f"ratio {report['ratio']:.2f}x, relative error {report['error']:.4f}")
+            src.Log.print_with_color(text, "yellow")
+            self.logger.log_info(text)
+
+    def report_step(self, layer_id, step):
+        if step["steps"] == 0:
+            return
+        precision = step.get("precision") or {"precision": "fp32", "skipped": 0}
+        text = (f"Round {self.round_number()}, layer {layer_id} ({step['mode']}, {precision['precision']}): "
+                f"forward {step['forward_time'] / 1e6:.2f} ms, backward {step['backward_time'] / 1e6:.2f} ms, "
+                f"peak memory {step['peak_memory'] / 2 ** 20:.1f} MB")
+        if precision["skipped"]:
+            text += (f", {precision['skipped']} micro-batches dropped on overflow "
+                     f"(loss scale {precision['scale']:g})")
+        src.Log.print_with_color(text, "yellow")
+        self.logger.log_info(text)
+
+    def report_inference(self, client_id, inference):
+        latency = inference["latency"]
+        text = (f"Round {self.round_number()}, split inference from client {client_id}: "
+                f"{inference['samples']} samples in {inference['batches']} batches, "
+                f"{inference['samples_per_s']:.1f} samples/s, batch latency p50 {latency['p50'] * 1e3:.2f} ms, "
+                f"p90 {latency['p90'] * 1e3:.2f} ms, p99 {latency['p99'] * 1e3:.2f} ms")
+        src.Log.print_with_color(text, "yellow")
+        self.logger.log_info(text)
+
+    def report_pipeline(self, layer_id, pipeline):
+        bubble = pipeline["bubble_time"] / max(pipeline["total_time"], 1)
+        if "window" in pipeline:
+            window = f"mean window {pipeline['window']:.1f}"
+        else:
+            window = f"fixed window {pipeline.get('fixed_window')}"
+        text = (f"Round {self.round_number()}, layer {layer_id} pipeline {pipeline['policy']}: "
+                f"{window}, bubble {pipeline['bubble_time'] / 1e6:.2f} ms "
+                f"({100 * bubble:.1f}% of {pipeline['total_time'] / 1e6:.2f} ms)")
+        src.Log.print_with_color(text, "yellow")
+        self.logger.log_info(text)
 
     def avg_all_parameters(self):
-        # Average all client parameters
-        for layer, state_dicts in enumerate(self.all_model_parameters):
-            all_layer_client_size = self.all_client_sizes[layer]
-            num_models = len(state_dicts)
-            if num_models == 0:
+        # Average all client parameters, already summed as they arrived
+        for layer, aggregator in enumerate(self.aggregators):
+            if aggregator.count == 0:
                 return
-
-            self.avg_state_dict[layer] = state_dicts[0]
-
-            for key in state_dicts[0].keys():
-                if state_dicts[0][key].dtype != torch.long:
-                    self.avg_state_dict[layer][key] = sum(state_dicts[i][key] * all_layer_client_size[i]
-                                                          for i in range(num_models)) / sum(all_layer_client_size)
-                else:
-                    self.avg_state_dict[layer][key] = sum(state_dicts[i][key] * all_layer_client_size[i]
-                                                          for i in range(num_models)) // sum(all_layer_client_size)
+            self.avg_state_dict[layer] = aggregator.result()
 
     def concatenate_state_dict(self):
         state_dict_full = {}
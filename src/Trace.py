@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+from collections import deque
+
+
+class Span:
+    __slots__ = ("tracer", "name", "data_id", "args", "start")
+
+    def __init__(self, tracer, name, data_id, args):
+        self.tracer = tracer
+        self.name = name
+        self.data_id = data_id
+        self.args = args
+
+    def tag(self, data_id):
+        # The data_id of a received message is only known once it arrives
+        self.data_id = data_id
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.events.append((self.name, self.start, time.time_ns() - self.start,
+                                   None if self.data_id is None else str(self.data_id),
+                                   threading.current_thread().name, self.args))
+        return False
+
+
+class NullSpan:
+    def tag(self, data_id):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """Named spans of one client, kept in a ring buffer of `capacity` events until `drain`.
+
+    Disabled tracers hand out a shared no-op span, so tracing calls can stay in the training loops.
+    """
+
+    def __init__(self, enabled=False, capacity=100000):
+        self.enabled = enabled
+        self.events = deque(maxlen=capacity)
+
+    def span(self, name, data_id=None, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, data_id, args)
+
+    def drain(self):
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+
+def chrome_trace(traces):
+    """Chrome trace (chrome://tracing, Perfetto) of `traces`: (client_id, layer_id, events) of each client.
+
+    Each layer is a process and each thread of a client a track.
+    """
+    trace_events = []
+    for layer_id in sorted({layer_id for _, layer_id, _ in traces}):
+        trace_events.append({"name": "process_name", "ph": "M", "pid": layer_id, "args": {"name": f"Layer {layer_id}"}})
+    for client_id, layer_id, events in traces:
+        for name, start, duration, data_id, thread, args in events:
+            args = dict(args, client_id=str(client_id))
+            if data_id is not None:
+                args["data_id"] = data_id
+            trace_events.append({"name": name, "ph": "X", "ts": start / 1000, "dur": duration / 1000,
+                                 "pid": layer_id, "tid": f"{str(client_id)[:8]} {thread}", "args": args})
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def save_chrome_trace(traces, path):
+    with open(path, "w") as file:
+        json.dump(chrome_trace(traces), file)
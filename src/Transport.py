@@ -0,0 +1,440 @@
+import time
+import queue as queue_module
+import threading
+from collections import defaultdict, deque
+from multiprocessing.managers import SyncManager
+
+import pika
+import requests
+import torch.multiprocessing  # registers shared-memory reductions for tensors
+
+from requests.auth import HTTPBasicAuth
+
+import src.Log
+import src.Metrics
+import src.Serialization
+
+
+class Transport:
+    """Message transport used by Server, RpcClient and Scheduler.
+
+    Messages are python dicts, each transport decides how to move them.
+    """
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def declare(self, queue):
+        raise NotImplementedError
+
+    def publish(self, queue, message):
+        raise NotImplementedError
+
+    def prepare(self, message):
+        """Encode `message` once for publishing it to several queues."""
+        return message
+
+    def receive(self, queues, timeout=None):
+        """Wait for the next message on any of `queues`, earlier queues are served first.
+
+        Return (queue, message), or (None, None) if nothing arrived within `timeout` seconds
+        (None waits forever, 0 only looks at what has already arrived).
+        """
+        raise NotImplementedError
+
+    def receive_unacked(self, queues, timeout=None):
+        """Like `receive`, but the broker keeps the message until `ack`. Returns (queue, message, tag)."""
+        queue, message = self.receive(queues, timeout)
+        return queue, message, None
+
+    def ack(self, tag):
+        pass
+
+    def requeue(self, queue, message, tag):
+        """Give back a message of `receive_unacked` that was not used, ahead of those still in `queue`."""
+        self.publish(queue, message)
+
+    def cancel(self):
+        """Stop the consumers opened by `receive`, so that other readers of the queues get the messages."""
+        pass
+
+    def consume(self, queue, callback):
+        """Register `callback(message)` on `queue`, called from `start_consuming`."""
+        raise NotImplementedError
+
+    def start_consuming(self):
+        raise NotImplementedError
+
+    def set_prefetch(self, count):
+        pass
+
+    def clear_queues(self):
+        pass
+
+
+class RabbitMQTransport(Transport):
+    def __init__(self, address, username, password, serialization="binary"):
+        self.address = address
+        self.username = username
+        self.password = password
+        self.serialization = serialization
+
+        self.connection = None
+        self.channel = None
+        self.buffers = {}
+        self.connect()
+
+    def connect(self):
+        credentials = pika.PlainCredentials(self.username, self.password)
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.address, 5672, '/', credentials))
+        self.channel = self.connection.channel()
+        self.buffers = {}
+
+    def close(self):
+        if self.connection and self.connection.is_open:
+            self.connection.close()
+
+    def declare(self, queue):
+        self.channel.queue_declare(queue=queue, durable=False)
+
+    def publish(self, queue, message):
+        if not isinstance(message, bytes):
+            message = self.prepare(message)
+        self.channel.basic_publish(exchange='', routing_key=queue, body=message)
+        src.Metrics.MESSAGES.inc(queue=src.Metrics.queue_family(queue), direction="out")
+        src.Metrics.BYTES.inc(len(message), direction="out")
+
+    def prepare(self, message):
+        start = time.perf_counter()
+        body = src.Serialization.dumps(message, self.serialization)
+        src.Metrics.SERIALIZATION.observe(time.perf_counter() - start, operation="serialize")
+        return body
+
+    def loads(self, queue, body):
+        src.Metrics.MESSAGES.inc(queue=src.Metrics.queue_family(queue), direction="in")
+        src.Metrics.BYTES.inc(len(body), direction="in")
+        start = time.perf_counter()
+        message = src.Serialization.loads(body)
+        src.Metrics.SERIALIZATION.observe(time.perf_counter() - start, operation="deserialize")
+        return message
+
+    def receive(self, queues, timeout=None):
+        queue, message, delivery_tag = self.receive_unacked(queues, timeout)
+        if message is not None:
+            self.ack(delivery_tag)
+        return queue, message
+
+    def receive_unacked(self, queues, timeout=None):
+        # Consumers of queues not requested now are stopped, their messages go to other consumers meanwhile
+        for queue in [queue for queue in self.buffers if queue not in queues]:
+            self.cancel_queue(queue)
+        for queue in queues:
+            if queue not in self.buffers:
+                self.buffers[queue] = deque()
+                # Deliveries are acked when they leave the buffer, so prefetch bounds what a consumer holds
+                self.channel.basic_consume(queue=queue, consumer_tag=f'{queue}_{id(self)}',
+                                           on_message_callback=self.buffer_message(self.buffers[queue]))
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for queue in queues:
+                if self.buffers[queue]:
+                    delivery_tag, body = self.buffers[queue].popleft()
+                    return queue, self.loads(queue, body), delivery_tag
+            if deadline is None:
+                self.connection.process_data_events(time_limit=None)
+            else:
+                remaining = deadline - time.monotonic()
+                self.connection.process_data_events(time_limit=max(remaining, 0))
+                if remaining <= 0 and not any(self.buffers[queue] for queue in queues):
+                    return None, None, None
+
+    def ack(self, delivery_tag):
+        self.channel.basic_ack(delivery_tag=delivery_tag)
+
+    def requeue(self, queue, message, delivery_tag):
+        # RabbitMQ puts a rejected message back at its place in the queue
+        self.channel.basic_reject(delivery_tag=delivery_tag, requeue=True)
+
+    @staticmethod
+    def buffer_message(buffer):
+        def on_message(ch, method, props, body):
+            buffer.append((method.delivery_tag, body))
+
+        return on_message
+
+    def cancel_queue(self, queue):
+        buffer = self.buffers.pop(queue)
+        self.channel.basic_cancel(consumer_tag=f'{queue}_{id(self)}')
+        while buffer:
+            delivery_tag, body = buffer.popleft()
+            self.channel.basic_reject(delivery_tag=delivery_tag, requeue=True)
+
+    def cancel(self):
+        for queue in list(self.buffers):
+            self.cancel_queue(queue)
+
+    def consume(self, queue, callback):
+        def on_message(ch, method, props, body):
+            callback(self.loads(queue, body))
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        self.channel.basic_consume(queue=queue, on_message_callback=on_message)
+
+    def start_consuming(self):
+        self.channel.start_consuming()
+
+    def set_prefetch(self, count):
+        self.channel.basic_qos(prefetch_count=count)
+
+    def clear_queues(self):
+        url = f'http://{self.address}:15672/api/queues'
+        response = requests.get(url, auth=HTTPBasicAuth(self.username, self.password))
+
+        if response.status_code != 200:
+            src.Log.print_with_color(
+                f"Failed to fetch queues from RabbitMQ Management API. Status code: {response.status_code}", "yellow")
+            return False
+
+        http_channel = self.connection.channel()
+        for queue in response.json():
+            queue_name = queue['name']
+            if queue_name.startswith("reply") or queue_name.startswith("intermediate_queue") or queue_name.startswith(
+                    "gradient_queue") or queue_name.startswith("rpc_queue") or queue_name.startswith("probe"):
+                try:
+                    http_channel.queue_delete(queue=queue_name)
+                    src.Log.print_with_color(f"Queue '{queue_name}' deleted.", "green")
+                except Exception as e:
+                    src.Log.print_with_color(f"Failed to delete queue '{queue_name}': {e}", "yellow")
+            else:
+                try:
+                    http_channel.queue_purge(queue=queue_name)
+                    src.Log.print_with_color(f"Queue '{queue_name}' purged.", "green")
+                except Exception as e:
+                    src.Log.print_with_color(f"Failed to purge queue '{queue_name}': {e}", "yellow")
+        if http_channel.is_open:
+            http_channel.close()
+        return True
+
+
+class LocalBroker:
+    """Named in-memory queues shared by every LocalTransport attached to the broker.
+
+    Used directly when server and clients run as threads of one process. Across processes,
+    use `LocalManager().LocalBroker()`: tensors in messages then travel through shared memory.
+    """
+
+    def __init__(self):
+        self.queues = defaultdict(deque)
+        self.condition = threading.Condition()
+
+    def declare(self, queue):
+        with self.condition:
+            self.queues[queue]
+
+    def put(self, queue, message):
+        with self.condition:
+            self.queues[queue].append(message)
+            self.condition.notify_all()
+
+    def put_front(self, queue, message):
+        with self.condition:
+            self.queues[queue].appendleft(message)
+            self.condition.notify_all()
+
+    def get_any(self, queues, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: any(self.queues[queue] for queue in queues), timeout)
+            for queue in queues:
+                if self.queues[queue]:
+                    return queue, self.queues[queue].popleft()
+            return None, None
+
+
+class LocalManager(SyncManager):
+    pass
+
+
+LocalManager.register("LocalBroker", LocalBroker)
+
+
+class LocalTransport(Transport):
+    def __init__(self, broker):
+        self.broker = broker
+        self.consumers = []
+
+    def declare(self, queue):
+        self.broker.declare(queue)
+
+    def publish(self, queue, message):
+        self.broker.put(queue, message)
+        src.Metrics.MESSAGES.inc(queue=src.Metrics.queue_family(queue), direction="out")
+
+    def receive(self, queues, timeout=None):
+        queue, message = self.broker.get_any(queues, timeout)
+        if message is not None:
+            src.Metrics.MESSAGES.inc(queue=src.Metrics.queue_family(queue), direction="in")
+        return queue, message
+
+    def requeue(self, queue, message, tag):
+        self.broker.put_front(queue, message)
+
+    def consume(self, queue, callback):
+        self.consumers.append((queue, callback))
+
+    def start_consuming(self):
+        callbacks = dict(self.consumers)
+        while True:
+            queue, message = self.receive(list(callbacks))
+            callbacks[queue](message)
+
+
+class AsyncTransport(Transport):
+    """Publishes and receives on background threads, each with its own transport built by `factory`.
+
+    `encode(queue, message, prepare)` runs on the sender thread before publishing and `decode(queue, message)`
+    on the receiver thread, so the caller only ever hands over and gets back ready messages.
+    Threads start on first use and stop on `cancel`.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.encode = None
+        self.decode = None
+        self.prefetch = 10
+
+        self.outbox = queue_module.Queue()
+        # (message, tag) taken from each queue, acked by the receiver thread once the caller took the message
+        self.inbox = defaultdict(deque)
+        self.acks = []
+        # Queues of the last `receive` call, the only ones the receiver thread takes from
+        self.queues = []
+        self.condition = threading.Condition()
+        self.running = False
+        self.sender = None
+        self.receiver = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.sender = threading.Thread(target=self.send_loop, daemon=True)
+        self.receiver = threading.Thread(target=self.receive_loop, daemon=True)
+        self.sender.start()
+        self.receiver.start()
+
+    def send_loop(self):
+        transport = self.factory()
+        declared = set()
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                break
+            queue, message = item
+            if self.encode:
+                message = self.encode(queue, message, transport.prepare)
+            if queue not in declared:
+                transport.declare(queue)
+                declared.add(queue)
+            transport.publish(queue, message)
+        transport.close()
+
+    def receive_loop(self):
+        transport = self.factory()
+        transport.set_prefetch(self.prefetch)
+        declared = set()
+        while self.running:
+            self.send_acks(transport)
+            with self.condition:
+                # Only take from the queues the caller waits on, and stop while their messages are not
+                # consumed yet. Unacked deliveries are also bounded by the prefetch window of the channel
+                queues = [queue for queue in self.queues if len(self.inbox[queue]) < self.prefetch]
+                if not queues:
+                    self.condition.wait(0.05)
+                    continue
+            for queue in queues:
+                if queue not in declared:
+                    transport.declare(queue)
+                    declared.add(queue)
+            queue, message, tag = transport.receive_unacked(queues, 0.05)
+            if message is None:
+                continue
+            if self.decode:
+                message = self.decode(queue, message)
+            with self.condition:
+                self.inbox[queue].append((message, tag))
+                self.condition.notify_all()
+
+        # Give back what was taken but not consumed, in place and in order, once nothing more is delivered
+        self.send_acks(transport)
+        transport.cancel()
+        with self.condition:
+            for queue, messages in self.inbox.items():
+                while messages:
+                    message, tag = messages.pop()
+                    transport.requeue(queue, message, tag)
+        transport.close()
+
+    def send_acks(self, transport):
+        with self.condition:
+            acks, self.acks = self.acks, []
+        for tag in acks:
+            transport.ack(tag)
+
+    def declare(self, queue):
+        pass
+
+    def publish(self, queue, message):
+        self.start()
+        self.outbox.put((queue, message))
+
+    def receive(self, queues, timeout=None):
+        self.start()
+        with self.condition:
+            if queues != self.queues:
+                # E.g. a stage whose window is full stops asking for forward messages, peers may take them
+                self.queues = list(queues)
+                self.condition.notify_all()
+            self.condition.wait_for(lambda: any(self.inbox[queue] for queue in queues), timeout)
+            for queue in queues:
+                if self.inbox[queue]:
+                    message, tag = self.inbox[queue].popleft()
+                    if tag is not None:
+                        self.acks.append(tag)
+                    self.condition.notify_all()
+                    return queue, message
+            return None, None
+
+    def cancel(self):
+        if not self.running:
+            return
+        self.outbox.put(None)
+        self.sender.join()
+        self.running = False
+        self.receiver.join()
+        self.queues = []
+
+    def set_prefetch(self, count):
+        self.prefetch = count
+
+
+def create_transport(config, broker=None, async_io=False):
+    if async_io:
+        return AsyncTransport(lambda: create_transport(config, broker))
+
+    transport_type = config.get("transport", "rabbitmq")
+    if transport_type == "local" or broker is not None:
+        if broker is None:
+            raise ValueError("Local transport requires a LocalBroker, run it through local_run.py.")
+        return LocalTransport(broker)
+    elif transport_type == "rabbitmq":
+        address = config["rabbit"]["address"]
+        username = config["rabbit"]["username"]
+        password = config["rabbit"]["password"]
+        serialization = config["rabbit"].get("serialization", "binary")
+        return RabbitMQTransport(address, username, password, serialization)
+    else:
+        raise ValueError(f"Transport '{transport_type}' is not supported.")
@@ -1,3 +1,11 @@
+import os
+import hashlib
+import tempfile
+import zipfile
+
+import numpy as np
+
+
 def change_state_dict(state_dicts, i):
     def change_name(name):
         parts = name.split(".", 1)
@@ -10,3 +18,45 @@ def change_state_dict(state_dicts, i):
         new_state_dict[new_key] = value
     return new_state_dict
 
+
+def slice_state_dict(state_dicts, start, end=None):
+    # Entries of layers [start, end) of a Sequential state_dict, numbered from 0 like the client's model part
+    selected = {}
+    for key, value in state_dicts.items():
+        number = int(key.split(".", 1)[0])
+        if number >= start and (end is None or number < end):
+            selected[key] = value
+    return change_state_dict(selected, -start)
+
+
+def label_to_indices(targets, cache_path=None):
+    """Indices of each label in `targets`, cached in `cache_path` (.npz) across restarts."""
+    targets = np.asarray(targets)
+    digest = hashlib.sha1(targets.tobytes()).hexdigest()
+
+    cached = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if str(cache["digest"]) == digest:
+                    cached = cache["labels"], cache["order"], cache["starts"]
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # Corrupt cache, rebuilt below
+            cached = None
+    if cached is not None:
+        labels, order, starts = cached
+    else:
+        order = np.argsort(targets, kind="stable")
+        labels, starts = np.unique(targets[order], return_index=True)
+        if cache_path:
+            # Written aside and renamed, clients starting together never read a partial file
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or ".", suffix=".npz")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    np.savez(file, digest=digest, labels=labels, order=order, starts=starts)
+                os.replace(temp_path, cache_path)
+            except OSError:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    return {int(label): indices.tolist() for label, indices in zip(labels, np.split(order, starts[1:]))}
@@ -1,52 +1,73 @@
-import torch
-import torch.nn as nn
-import numpy as np
+import time
 import math
-from tqdm import tqdm
 
-import torchvision
-import torchvision.transforms as transforms
+import numpy as np
+import torch
 import torch.nn.functional as F
+import torchvision
 
 import src.Model
+from src.Dataset import TensorLoader
 
+# Kept for the lifetime of the validation worker: the normalized test set and one model per class
+test_set = None
+models = {}
 
-def test(model_name, state_dict_full, logger):
-    transform_test = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-    ])
 
-    testset = torchvision.datasets.CIFAR10(
-        root='./data', train=False, download=True, transform=transform_test)
-    test_loader = torch.utils.data.DataLoader(
-        testset, batch_size=100, shuffle=False, num_workers=2)
+def load_test_set():
+    """CIFAR-10 test images normalized as one float tensor, and their labels."""
+    global test_set
+    if test_set is None:
+        testset = torchvision.datasets.CIFAR10(root='./data', train=False, download=True)
+        loader = TensorLoader(testset.data, testset.targets, len(testset.targets), shuffle=False, augment=False)
+        test_set = next(iter(loader))
+    return test_set
 
-    klass = getattr(src.Model, model_name)
-    if klass is None:
-        raise ValueError(f"Class '{model_name}' does not exist.")
-    model = klass()
-    model = nn.Sequential(*nn.ModuleList(model.children()))
+
+def load_model(model_name, state_dict_full, fuse=False):
+    if model_name not in models:
+        models[model_name] = src.Model.build_stage(model_name)
+    model = models[model_name]
     model.load_state_dict(state_dict_full)
     # evaluation mode
     model.eval()
+    return src.Model.fuse_stage(model) if fuse else model
+
+
+def test(model_name, state_dict_full, logger, subsample=0, batch_size=1000, threads=0, fuse=False):
+    """Loss and accuracy of the model on the test set, False if the loss diverged.
+
+    With `subsample`, only that many test samples are used, the same ones on every call. With `fuse`,
+    the model is evaluated with every Conv+BN folded.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    images, labels = load_test_set()
+    if subsample and subsample < len(labels):
+        indices = torch.randperm(len(labels), generator=torch.Generator().manual_seed(0))[:subsample]
+        images, labels = images[indices], labels[indices]
+    model = load_model(model_name, state_dict_full, fuse)
+
+    start = time.perf_counter()
     test_loss = 0
     correct = 0
-    for data, target in tqdm(test_loader):
-        output = model(data)
-        test_loss += F.nll_loss(output, target, reduction='sum').item()
-        pred = output.data.max(1, keepdim=True)[1]  # get the index of the max log-probability
-        correct += pred.eq(target.data.view_as(pred)).long().cpu().sum()
+    with torch.inference_mode():
+        for i in range(0, len(labels), batch_size):
+            output = model(images[i:i + batch_size])
+            target = labels[i:i + batch_size]
+            test_loss += F.nll_loss(output, target, reduction='sum').item()
+            correct += (output.argmax(1) == target).sum().item()
+    elapsed = time.perf_counter() - start
 
-    test_loss /= len(test_loader.dataset)
-    accuracy = 100.0 * correct / len(test_loader.dataset)
-    print('Test set: Average loss: {:.4f}, Accuracy: {}/{} ({:.2f}%)\n'.format(
-        test_loss, correct, len(test_loader.dataset), accuracy))
+    test_loss /= len(labels)
+    accuracy = 100.0 * correct / len(labels)
+    text = 'Test set: Average loss: {:.4f}, Accuracy: {}/{} ({:.2f}%), {:.0f} samples/s'.format(
+        test_loss, correct, len(labels), accuracy, len(labels) / elapsed)
+    print(text + '\n')
 
     if np.isnan(test_loss) or math.isnan(test_loss) or abs(test_loss) > 10e5:
         return False
     else:
-        logger.log_info('Test set: Average loss: {:.4f}, Accuracy: {}/{} ({:.2f}%)\n'.format(
-            test_loss, correct, len(test_loader.dataset), accuracy))
+        logger.log_info(text + '\n')
 
     return True
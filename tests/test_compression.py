@@ -0,0 +1,18 @@
+import torch
+
+from src.Compression import decompress
+from src.Scheduler import Scheduler
+from src.Transport import LocalBroker, LocalTransport
+
+
+def test_messages_do_not_depend_on_previous_tensors():
+    scheduler = Scheduler("client", 2, LocalTransport(LocalBroker()), "cpu")
+    scheduler.set_compression({"activation": "topk", "gradient": "topk", "topk-ratio": 0.1})
+    torch.manual_seed(0)
+    x = torch.randn(8, 16, 4, 4)
+    for queue in ("intermediate_queue_2", "gradient_queue_1_client"):
+        alone = decompress(scheduler.encode_message(queue, {"data": x, "test": False})["data"])
+        for _ in range(3):
+            scheduler.encode_message(queue, {"data": torch.randn(8, 16, 4, 4), "test": False})
+        after = decompress(scheduler.encode_message(queue, {"data": x, "test": False})["data"])
+        assert torch.equal(alone, after)
@@ -0,0 +1,86 @@
+import os
+import uuid
+from concurrent.futures import Future
+
+import torch
+import yaml
+
+from src.Server import Server
+from src.Transport import LocalBroker
+
+CONFIG = {
+    "name": "Split Learning",
+    "server": {"num-round": 2, "cut_layers": [3], "clients": [1, 1], "model": "LeNet",
+               "parameters": {"load": False, "save": True}, "validation": True, "speculative-round": True},
+    "transport": "local",
+    "log_path": ".",
+    "learning": {"learning-rate": 0.01, "momentum": 0.5, "batch-size": 32, "control-count": 1},
+}
+
+
+class RejectingValidator:
+    """Validation worker whose every round fails."""
+
+    def submit(self, *args):
+        future = Future()
+        future.set_result(False)
+        return future
+
+    def shutdown(self):
+        pass
+
+
+def start_messages(broker, clients):
+    messages = {}
+    for client_id, layer_id in clients:
+        _, message = broker.get_any([f"reply_{client_id}"], timeout=0)
+        assert message["action"] == "START"
+        messages[layer_id] = message
+    return messages
+
+
+def send_updates(server, clients, starts):
+    # Every client trains: its parameters move away from the ones it received
+    for client_id, layer_id in clients:
+        parameters = {key: value + 1.0 for key, value in starts[layer_id]["parameters"].items()}
+        server.on_request({"action": "UPDATE", "client_id": client_id, "layer_id": layer_id, "result": True,
+                           "size": 1, "stats": None, "message": "Sent parameters to Server",
+                           "parameters": parameters, "version": None})
+
+
+def handle_validated(server, broker):
+    _, message = broker.get_any(["rpc_queue"], timeout=0)
+    assert message["action"] == "VALIDATED"
+    server.on_request(message)
+
+
+def test_rejected_first_round_restarts_from_initial_parameters(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("config.yaml", "w") as file:
+        yaml.safe_dump(CONFIG, file)
+    broker = LocalBroker()
+    server = Server("config.yaml", broker)
+    server.validator.shutdown()
+    server.validator = RejectingValidator()
+    clients = [(str(uuid.uuid4()), 1), (str(uuid.uuid4()), 2)]
+
+    for client_id, layer_id in clients:
+        server.on_request({"action": "REGISTER", "client_id": client_id, "layer_id": layer_id,
+                           "message": "Hello from Client!"})
+    initial = start_messages(broker, clients)
+    assert all(message["parameters"] for message in initial.values())
+
+    # Round 1 ends, round 2 starts speculatively on the averaged parameters while they are validated
+    send_updates(server, clients, initial)
+    speculative = start_messages(broker, clients)
+    handle_validated(server, broker)
+
+    # Round 2 ends on top of rejected parameters: it is discarded and round 1 is trained again
+    send_updates(server, clients, speculative)
+    retry = start_messages(broker, clients)
+    assert not os.path.exists("LeNet.pth")
+    for layer_id, message in retry.items():
+        assert message["parameters"].keys() == initial[layer_id]["parameters"].keys()
+        for key, value in message["parameters"].items():
+            assert torch.equal(value, initial[layer_id]["parameters"][key])
+            assert not torch.equal(value, speculative[layer_id]["parameters"][key])